@@ -0,0 +1,69 @@
+import time
+import argparse
+import logging
+from utils import create_dictionaries, create_training_data_from_xml, extract_features, tokens2features
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Check that tokens2features matches extract_features and compare their throughput.')
+    parser.add_argument('-t', '--training_data', type=str,
+                        default='data/tagged_affiliations.xml', help='Input XML file containing training data')
+    parser.add_argument('-c', '--countries', type=str,
+                        default='data/countries.txt', help='File containing list of countries')
+    parser.add_argument('-n', '--institutions', type=str,
+                        default='data/institution_keywords.txt', help='File containing institution keywords')
+    parser.add_argument('-d', '--addresses', type=str,
+                        default='data/address_keywords.txt', help='File containing address keywords')
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='Number of timed passes over the corpus')
+    return parser.parse_args()
+
+
+def per_token_features(tokens, country_dict, institution_dict, address_dict):
+    return [extract_features(tokens, i, country_dict, institution_dict, address_dict) for i in range(len(tokens))]
+
+
+def find_mismatches(sentences, country_dict, institution_dict, address_dict):
+    mismatches = []
+    for tokens in sentences:
+        expected = per_token_features(tokens, country_dict, institution_dict, address_dict)
+        actual = tokens2features(tokens, country_dict, institution_dict, address_dict)
+        if [list(f.items()) for f in expected] != [list(f.items()) for f in actual]:
+            mismatches.append(tokens)
+    return mismatches
+
+
+def tokens_per_second(featurize, sentences, dictionaries, repeats):
+    n_tokens = sum(len(tokens) for tokens in sentences)
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for tokens in sentences:
+            featurize(tokens, *dictionaries)
+        best = min(best, time.perf_counter() - start)
+    return n_tokens / best
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    dictionaries = create_dictionaries(
+        args.countries, args.institutions, args.addresses)
+    sentences = [[token for token, label in sent]
+                 for sent in create_training_data_from_xml(args.training_data)]
+    logging.info(f"Checking feature equivalence on {len(sentences)} affiliations...")
+    mismatches = find_mismatches(sentences, *dictionaries)
+    if mismatches:
+        logging.error(f"{len(mismatches)} affiliations produced different features, e.g. {mismatches[0]}")
+        raise SystemExit(1)
+    logging.info("Features are identical for all affiliations.")
+    before = tokens_per_second(per_token_features, sentences, dictionaries, args.repeats)
+    after = tokens_per_second(tokens2features, sentences, dictionaries, args.repeats)
+    logging.info(f"extract_features: {before:,.0f} tokens/sec")
+    logging.info(f"tokens2features: {after:,.0f} tokens/sec ({after / before:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
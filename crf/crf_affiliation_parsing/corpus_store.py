@@ -0,0 +1,143 @@
+import os
+import gzip
+import json
+import pickle
+import hashlib
+import logging
+from itertools import islice
+from datetime import datetime, timezone
+from utils import expand_corpus_paths, iter_training_data_from_xml
+
+
+STORE_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def update_digest(digest, sent):
+    digest.update(json.dumps(sent).encode('utf-8') + b'\n')
+
+
+def feature_config(country_file, institution_file, address_file, gazetteer=False):
+    # Stored features are only valid for the dictionaries and options they
+    # were computed with
+    return {
+        'store_version': STORE_VERSION,
+        'gazetteer': bool(gazetteer),
+        'dictionaries': {name: file_hash(path) for name, path in
+                         (('countries', country_file), ('institutions', institution_file),
+                          ('addresses', address_file))},
+    }
+
+
+def write_atomic(path, write):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# Featurized training sentences in append-only shards. Each append featurizes
+# only the sentences added to the corpus files since the last one, so a
+# retrain reads the stored features instead of parsing and featurizing the
+# whole corpus again. The store holds the same sentences, duplicates
+# included, as the corpus files it was built from.
+class CorpusStore:
+    def __init__(self, path, config):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        manifest_path = os.path.join(path, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+            if self.manifest['config'] != config:
+                raise ValueError(f"Corpus store {path} was featurized with different dictionaries or "
+                                 f"options, use a new store directory")
+        else:
+            self.manifest = {'config': config, 'dataset_version': 0, 'sentences': 0,
+                             'sources': {}, 'shards': [], 'models': []}
+
+    def new_sentences(self, paths, sources):
+        # Corpus files are expected to only grow. The sentences already stored
+        # from a file are skipped after checking they have not changed.
+        for path in expand_corpus_paths(paths):
+            source = os.path.abspath(path)
+            file_digest = file_hash(path)
+            stored = self.manifest['sources'].get(source, {'sha256': None, 'sentences': 0, 'digest': None})
+            if stored['sha256'] == file_digest:
+                logging.info(f"{path} is unchanged since it was added to the corpus store")
+                continue
+            digest = hashlib.sha256()
+            sents = iter_training_data_from_xml(path)
+            for sent in islice(sents, stored['sentences']):
+                update_digest(digest, sent)
+            if stored['sentences'] and digest.hexdigest() != stored['digest']:
+                raise ValueError(f"Sentences already in the corpus store were changed or removed in {path}, "
+                                 f"rebuild the store in a new directory")
+            count = stored['sentences']
+            for sent in sents:
+                update_digest(digest, sent)
+                count += 1
+                yield sent
+            sources[source] = {'sha256': file_digest, 'sentences': count, 'digest': digest.hexdigest()}
+
+    def append(self, paths, featurize_fn):
+        sources = {}
+        sents = list(self.new_sentences(paths, sources))
+        if sents:
+            features = [x for x, _ in featurize_fn(sents)]
+            shard = f"shard-{len(self.manifest['shards']):05d}.pkl.gz"
+            write_atomic(os.path.join(self.path, shard), lambda f: f.write(gzip.compress(
+                pickle.dumps(list(zip(sents, features)), protocol=pickle.HIGHEST_PROTOCOL), compresslevel=1)))
+            self.manifest['shards'].append({'file': shard, 'sentences': len(sents),
+                                            'sha256': file_hash(os.path.join(self.path, shard))})
+            self.manifest['sentences'] += len(sents)
+            self.manifest['dataset_version'] += 1
+        # The manifest is written last, so a shard from an append that did not
+        # complete is never read and is overwritten by the next one
+        self.manifest['sources'].update(sources)
+        self.save_manifest()
+        return len(sents)
+
+    def read_shard(self, shard):
+        with open(os.path.join(self.path, shard['file']), 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != shard['sha256']:
+            raise ValueError(f"Shard {shard['file']} of corpus store {self.path} does not match its "
+                             f"hash in the manifest, rebuild the store in a new directory")
+        examples = pickle.loads(gzip.decompress(data))
+        if len(examples) != shard['sentences']:
+            raise ValueError(f"Shard {shard['file']} of corpus store {self.path} has {len(examples)} "
+                             f"sentences, expected {shard['sentences']}")
+        return examples
+
+    def iter_examples(self):
+        for shard in self.manifest['shards']:
+            yield from self.read_shard(shard)
+
+    def iter_sentences(self):
+        return (sent for sent, _ in self.iter_examples())
+
+    def record_model(self, output, params, training_seconds):
+        model = {'model_version': len(self.manifest['models']) + 1,
+                 'dataset_version': self.manifest['dataset_version'],
+                 'sentences': self.manifest['sentences'],
+                 'output': os.path.abspath(output), 'params': params,
+                 'warm_start': False, 'training_seconds': round(training_seconds, 3),
+                 'trained_at': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+        self.manifest['models'].append(model)
+        self.save_manifest()
+        return model
+
+    def save_manifest(self):
+        write_atomic(os.path.join(self.path, MANIFEST_NAME),
+                     lambda f: f.write(json.dumps(self.manifest, indent=2).encode('utf-8')))
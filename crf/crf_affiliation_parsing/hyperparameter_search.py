@@ -0,0 +1,104 @@
+import csv
+import math
+import time
+import random
+import itertools
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+
+search_state = {}
+
+
+def init_search(X, y, train_fn):
+    search_state.update(X=X, y=y, train_fn=train_fn)
+
+
+def kfold_indices(n, folds, seed=42):
+    indices = list(range(n))
+    random.Random(seed).shuffle(indices)
+    return [sorted(indices[i::folds]) for i in range(folds)]
+
+
+def grid_candidates(c1_values, c2_values, max_iterations_values):
+    return [{'c1': c1, 'c2': c2, 'max_iterations': max_iterations}
+            for c1, c2, max_iterations in itertools.product(c1_values, c2_values, max_iterations_values)]
+
+
+def random_candidates(c1_values, c2_values, max_iterations_values, n_candidates, seed=42):
+    # c1 and c2 are drawn log-uniformly between the smallest and largest
+    # positive value given. A 0 (no regularization) has no logarithm, so when
+    # it is given it is drawn as one of the values with equal probability.
+    rng = random.Random(seed)
+
+    def log_uniform(values):
+        positive = [value for value in values if value > 0]
+        if not positive or (len(positive) < len(values) and rng.random() < 1 / len(set(values))):
+            return 0.0
+        low, high = math.log(min(positive)), math.log(max(positive))
+        return round(math.exp(rng.uniform(low, high)), 6)
+    return [{'c1': log_uniform(c1_values), 'c2': log_uniform(c2_values),
+             'max_iterations': rng.choice(max_iterations_values)} for _ in range(n_candidates)]
+
+
+def label_f1_scores(y_true, y_pred):
+    counts = {'tp': Counter(), 'fp': Counter(), 'fn': Counter()}
+    for true_seq, pred_seq in zip(y_true, y_pred):
+        for true_label, pred_label in zip(true_seq, pred_seq):
+            if true_label == pred_label:
+                counts['tp'][true_label] += 1
+            else:
+                counts['fp'][pred_label] += 1
+                counts['fn'][true_label] += 1
+    scores = {}
+    for label in set(counts['tp']) | set(counts['fp']) | set(counts['fn']):
+        tp, fp, fn = counts['tp'][label], counts['fp'][label], counts['fn'][label]
+        scores[label] = 2 * tp / (2 * tp + fp + fn) if tp else 0.0
+    return scores
+
+
+def evaluate_fold(params, test_indices):
+    X, y, train_fn = search_state['X'], search_state['y'], search_state['train_fn']
+    test = set(test_indices)
+    train_indices = [i for i in range(len(X)) if i not in test]
+    start = time.perf_counter()
+    model = train_fn([X[i] for i in train_indices],
+                     [y[i] for i in train_indices], **params)
+    train_time = time.perf_counter() - start
+    y_pred = model.predict([X[i] for i in test_indices])
+    return label_f1_scores([y[i] for i in test_indices], y_pred), train_time
+
+
+def run_search(X, y, candidates, train_fn, folds=5, workers=1, seed=42):
+    fold_indices = kfold_indices(len(X), folds, seed)
+    tasks = [(c, fold) for c in range(len(candidates)) for fold in fold_indices]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_search,
+                                 initargs=(X, y, train_fn)) as executor:
+            futures = [executor.submit(evaluate_fold, candidates[c], fold) for c, fold in tasks]
+            fold_results = [future.result() for future in futures]
+    else:
+        init_search(X, y, train_fn)
+        fold_results = [evaluate_fold(candidates[c], fold) for c, fold in tasks]
+
+    leaderboard = []
+    for c, params in enumerate(candidates):
+        results = [result for (task_c, _), result in zip(tasks, fold_results) if task_c == c]
+        labels = sorted(set(label for scores, _ in results for label in scores))
+        entry = dict(params)
+        for label in labels:
+            entry[f'f1_{label}'] = sum(scores.get(label, 0.0) for scores, _ in results) / len(results)
+        entity_labels = [label for label in labels if label != 'O'] or labels
+        entry['macro_f1'] = sum(entry[f'f1_{label}'] for label in entity_labels) / len(entity_labels)
+        entry['train_seconds'] = sum(train_time for _, train_time in results) / len(results)
+        leaderboard.append(entry)
+    leaderboard.sort(key=lambda entry: (-entry['macro_f1'], entry['train_seconds']))
+    return leaderboard
+
+
+def write_leaderboard(leaderboard, file_path):
+    with open(file_path, 'w', newline='') as f:
+        fieldnames = list(dict.fromkeys(key for entry in leaderboard for key in entry))
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval=0.0)
+        writer.writeheader()
+        writer.writerows(leaderboard)
@@ -1,18 +1,33 @@
 import os
+import time
 import argparse
 import logging
 import joblib
+from collections import deque
+from itertools import tee
+from concurrent.futures import ProcessPoolExecutor
+from tabulate import tabulate
 from sklearn_crfsuite import CRF
-from utils import create_dictionaries, create_training_data_from_xml, sent2features, sent2labels
+from compiled_crf import CompiledCRF, mapped_model_path
+from corpus_store import CorpusStore, feature_config
+from hyperparameter_search import grid_candidates, random_candidates, run_search, write_leaderboard
+from utils import create_dictionaries, build_gazetteer, iter_training_data_from_xml, sent2features, sent2labels, tokens2features
+
+
+def non_negative_float(value):
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"Invalid value {value}, regularization values must be 0 or more")
+    return number
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Train CRF model for affiliation parsing.')
-    parser.add_argument('-t', '--training_data', type=str,
-                        default='data/tagged_affiliations.xml', help='Input XML file containing training data')
+    parser.add_argument('-t', '--training_data', type=str, nargs='+', default=['data/tagged_affiliations.xml'],
+                        help='Input XML files (optionally gzipped), directories or glob patterns containing training data')
     parser.add_argument('-o', '--output', type=str, default='model/affiliation_parser_crf_model.joblib',
-                        help='Output file to save the trained model')
+                        help='Output file to save the trained model (a memory-mapped .crfm copy is saved next to it)')
     parser.add_argument('-c', '--countries', type=str,
                         default='data/countries.txt', help='File containing list of countries')
     parser.add_argument('-n', '--institutions', type=str,
@@ -25,9 +40,96 @@ def parse_arguments():
                         help='L2 regularization parameter')
     parser.add_argument('--max_iterations', type=int,
                         default=100, help='Maximum number of iterations')
+    parser.add_argument('--gazetteer', action='store_true',
+                        help='Add multi-word dictionary match features')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of featurization processes (1 featurizes in the main process)')
+    parser.add_argument('--chunk_size', type=int, default=500,
+                        help='Number of affiliations sent to a featurization process at a time')
+    parser.add_argument('--corpus_store', type=str,
+                        help='Directory of featurized training sentences; only sentences not stored yet are featurized and added, then the model is trained on the whole store')
+    parser.add_argument('--export_compiled', type=str,
+                        help='Also save a compiled NumPy version of the model (.npz) for fast inference, after checking it labels the training data identically')
+    parser.add_argument('--search', choices=['grid', 'random'],
+                        help='Search c1/c2/max_iterations with cross-validation and save the best model')
+    parser.add_argument('--c1_values', type=non_negative_float, nargs='+', default=[0.01, 0.05, 0.1, 0.5],
+                        help='c1 values for grid search (random search samples between their min and max)')
+    parser.add_argument('--c2_values', type=non_negative_float, nargs='+', default=[0.01, 0.05, 0.1, 0.5],
+                        help='c2 values for grid search (random search samples between their min and max)')
+    parser.add_argument('--max_iterations_values', type=int, nargs='+', default=[50, 100, 200],
+                        help='max_iterations values to search')
+    parser.add_argument('--n_candidates', type=int, default=10,
+                        help='Number of configurations sampled by random search')
+    parser.add_argument('--folds', type=int, default=5,
+                        help='Number of cross-validation folds')
+    parser.add_argument('--search_workers', type=int, default=os.cpu_count(),
+                        help='Number of processes training candidate models')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed for fold assignment and random search')
+    parser.add_argument('--leaderboard', type=str,
+                        help='CSV file to write the search leaderboard to')
     return parser.parse_args()
 
 
+featurizer_args = ()
+
+
+def init_featurizer(*args):
+    global featurizer_args
+    featurizer_args = args
+
+
+def featurize_chunk(sents):
+    return [(sent2features(s, *featurizer_args), sent2labels(s)) for s in sents]
+
+
+def iter_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def featurize(sents, country_dict, institution_dict, address_dict, gazetteer=None, workers=1, chunk_size=500):
+    dictionaries = (country_dict, institution_dict, address_dict, gazetteer)
+    if workers <= 1:
+        for s in sents:
+            yield sent2features(s, *dictionaries), sent2labels(s)
+        return
+    # Keep a bounded number of chunks in flight so that features are handed
+    # to the trainer as they are produced, in input order
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_featurizer,
+                             initargs=dictionaries) as executor:
+        pending = deque()
+        for chunk in iter_chunks(sents, chunk_size):
+            pending.append(executor.submit(featurize_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def timed(iterable, timings, phase):
+    iterator = iter(iterable)
+    end = object()
+    while True:
+        start = time.perf_counter()
+        item = next(iterator, end)
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+        if item is end:
+            return
+        yield item
+
+
+def split_pairs(pairs):
+    features, labels = tee(pairs)
+    return (x for x, _ in features), (y for _, y in labels)
+
+
 def train_crf_model(X_train, y_train, **kwargs):
     crf = CRF(
         algorithm='lbfgs',
@@ -44,25 +146,121 @@ def train_crf_model(X_train, y_train, **kwargs):
 def save_model(model, file_path):
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
     joblib.dump(model, file_path)
+    # Memory-mapped copy of the weights for fast startup, see load_crf_model
+    CompiledCRF.from_crf(model).save_mapped(mapped_model_path(file_path))
+
+
+def verify_compiled(crf_model, compiled, sents, country_dict, institution_dict, address_dict, gazetteer=None, chunk_size=500):
+    mismatches = 0
+    total = 0
+    for chunk in iter_chunks(sents, chunk_size):
+        token_lists = [[token for token, _ in sent] for sent in chunk]
+        expected = crf_model.predict([tokens2features(tokens, country_dict, institution_dict, address_dict, gazetteer)
+                                      for tokens in token_lists])
+        predicted = compiled.predict_tokens(token_lists, country_dict, institution_dict, address_dict, gazetteer)
+        mismatches += sum(list(e) != p for e, p in zip(expected, predicted))
+        total += len(chunk)
+    return mismatches, total
+
+
+def search_and_train(args, X, y):
+    if args.search == 'grid':
+        candidates = grid_candidates(
+            args.c1_values, args.c2_values, args.max_iterations_values)
+    else:
+        candidates = random_candidates(args.c1_values, args.c2_values, args.max_iterations_values,
+                                       args.n_candidates, seed=args.seed)
+    logging.info(f"Evaluating {len(candidates)} configurations with {args.folds}-fold "
+                 f"cross-validation on {args.search_workers} worker(s)...")
+    leaderboard = run_search(X, y, candidates, train_crf_model, folds=args.folds,
+                             workers=args.search_workers, seed=args.seed)
+    logging.info("Leaderboard:\n" + tabulate(leaderboard, headers='keys', floatfmt='.4f'))
+    if args.leaderboard:
+        write_leaderboard(leaderboard, args.leaderboard)
+    best = {key: leaderboard[0][key] for key in ('c1', 'c2', 'max_iterations')}
+    logging.info(f"Training final model on all data with {best}...")
+    return train_crf_model(X, y, **best)
 
 
 def main():
     args = parse_arguments()
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
+    timings = {}
     logging.info("Creating dictionaries...")
+    start = time.perf_counter()
     country_dict, institution_dict, address_dict = create_dictionaries(
         args.countries, args.institutions, args.addresses)
-    logging.info("Loading and preprocessing training data...")
-    train_sents = create_training_data_from_xml(args.training_data)
-    X_train = [sent2features(
-        s, country_dict, institution_dict, address_dict) for s in train_sents]
-    y_train = [sent2labels(s) for s in train_sents]
-    logging.info("Training CRF model...")
-    crf_model = train_crf_model(
-        X_train, y_train, c1=args.c1, c2=args.c2, max_iterations=args.max_iterations)
-    logging.info(f"Saving model to {args.output}...")
+    gazetteer = build_gazetteer(
+        country_dict, institution_dict, address_dict) if args.gazetteer else None
+    timings['dictionaries'] = time.perf_counter() - start
+    store = None
+    if args.corpus_store:
+        store = CorpusStore(args.corpus_store, feature_config(
+            args.countries, args.institutions, args.addresses, args.gazetteer))
+        logging.info(f"Adding new training sentences to the corpus store {args.corpus_store}...")
+        start = time.perf_counter()
+        added = store.append(args.training_data, lambda sents: featurize(
+            sents, country_dict, institution_dict, address_dict, gazetteer,
+            workers=args.workers, chunk_size=args.chunk_size))
+        timings['store_update'] = time.perf_counter() - start
+        logging.info(f"Added {added} sentences, the store has {store.manifest['sentences']} "
+                     f"(dataset version {store.manifest['dataset_version']})")
+        logging.info("Streaming stored features and training CRF model...")
+        pairs = ((features, sent2labels(sent)) for sent, features in store.iter_examples())
+        X_train, y_train = split_pairs(timed(pairs, timings, 'store_loading'))
+    else:
+        logging.info(f"Streaming training data, featurizing with {args.workers} worker(s) and training CRF model...")
+        train_sents = timed(iter_training_data_from_xml(args.training_data), timings, 'loading')
+        pairs = featurize(train_sents, country_dict, institution_dict, address_dict, gazetteer,
+                          workers=args.workers, chunk_size=args.chunk_size)
+        X_train, y_train = split_pairs(timed(pairs, timings, 'featurization'))
+    start = time.perf_counter()
+    if args.search:
+        # Cross-validation reuses the same features for every fold and
+        # configuration, so they are featurized once up front
+        X_train, y_train = list(X_train), list(y_train)
+        crf_model = search_and_train(args, X_train, y_train)
+    else:
+        crf_model = train_crf_model(
+            X_train, y_train, c1=args.c1, c2=args.c2, max_iterations=args.max_iterations)
+    # Loading happens inside the featurization stream, which in turn runs
+    # inside the trainer's loop
+    streamed = 'store_loading' if store else 'featurization'
+    timings['training'] = time.perf_counter() - start - timings[streamed]
+    if not store:
+        timings['featurization'] -= timings['loading']
+    logging.info(f"Saving model to {args.output} and {mapped_model_path(args.output)}...")
+    start = time.perf_counter()
     save_model(crf_model, args.output)
+    timings['saving'] = time.perf_counter() - start
+    if store:
+        # CRFsuite's L-BFGS trainer cannot start from existing weights, so
+        # every model is refit on the whole store
+        model = store.record_model(args.output, {'c1': crf_model.c1, 'c2': crf_model.c2,
+                                                 'max_iterations': crf_model.max_iterations},
+                                   timings['training'])
+        logging.info(f"Recorded model version {model['model_version']} for dataset version "
+                     f"{model['dataset_version']} in the corpus store")
+    if args.export_compiled:
+        logging.info("Compiling model and checking it against the training data...")
+        start = time.perf_counter()
+        compiled = CompiledCRF.from_crf(crf_model)
+        mismatches, total = verify_compiled(
+            crf_model, compiled,
+            store.iter_sentences() if store else iter_training_data_from_xml(args.training_data), country_dict,
+            institution_dict, address_dict, gazetteer, chunk_size=args.chunk_size)
+        if mismatches:
+            logging.error(f"Compiled model labels {mismatches} of {total} sequences differently, not saving it")
+        else:
+            logging.info(f"Compiled model labels all {total} sequences identically, saving to {args.export_compiled}...")
+            save_model_dir = os.path.dirname(args.export_compiled)
+            if save_model_dir:
+                os.makedirs(save_model_dir, exist_ok=True)
+            compiled.save(args.export_compiled)
+        timings['compiling'] = time.perf_counter() - start
+    logging.info("Phase timings: " + ", ".join(
+        f"{phase} {seconds:.2f}s" for phase, seconds in timings.items()))
     logging.info("Training complete.")
 
 
@@ -0,0 +1,223 @@
+import json
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from rate_limiter import HostRateLimiter, rate_limit_spec
+from response_cache import ResponseCache
+from ror_index import RorIndex
+from instrumentation import metrics
+
+
+MARPLE_URL = "https://marple.research.crossref.org/match"
+ROR_URL = "https://api.ror.org/organizations"
+
+
+def create_session(pool_size=10, retries=3, backoff_factor=0.5):
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET',),
+                  respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class FixtureRecorder:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.f = open(path, 'a', encoding='utf-8')
+
+    def record(self, endpoint, query, response):
+        line = json.dumps({'endpoint': endpoint, 'query': query, 'response': response})
+        with self.lock:
+            self.f.write(line + '\n')
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class RemoteBackend:
+    name = None
+    query_param = None
+    remote = True
+
+    def __init__(self, base_url, session=None, rate_limiter=None, cache=None, recorder=None, timeout=30):
+        self.base_url = base_url
+        # Responses are cached per endpoint, so a cache file shared by runs
+        # against a fixture server and the real API never mixes them
+        self.cache_endpoint = f"{self.name}:{base_url}"
+        self.session = session or create_session()
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.recorder = recorder
+        self.timeout = timeout
+
+    def build_params(self, query):
+        return {self.query_param: query}
+
+    def parse_response(self, query, api_response, verbose):
+        raise NotImplementedError
+
+    def query(self, query, verbose=False):
+        if self.cache:
+            cached = self.cache.get(self.cache_endpoint, query)
+            metrics.increment(f"{self.name}_cache_{'hit' if cached is not None else 'miss'}")
+            if cached is not None:
+                if verbose:
+                    logging.debug(f"{self.name} cache hit for '{query}': {cached}")
+                return cached
+        results = []
+        try:
+            if self.rate_limiter:
+                self.rate_limiter.wait(self.base_url)
+            with metrics.timer(f"http_{self.name}"):
+                r = self.session.get(self.base_url, params=self.build_params(query), timeout=self.timeout)
+            retries = getattr(r.raw, 'retries', None)
+            if retries is not None and retries.history:
+                metrics.increment(f"{self.name}_http_retries", len(retries.history))
+            r.raise_for_status()
+            api_response = r.json()
+            if self.recorder:
+                self.recorder.record(self.name, query, api_response)
+            results = self.parse_response(query, api_response, verbose)
+            if results is None:
+                results = []
+            elif self.cache:
+                self.cache.set(self.cache_endpoint, query, results)
+        except Exception as e:
+            metrics.increment(f"{self.name}_http_errors")
+            logging.error(f'Error in {self.name} query: {query} - {e}')
+        return results
+
+
+class MarpleBackend(RemoteBackend):
+    name = 'marple'
+    query_param = 'input'
+
+    def __init__(self, base_url=MARPLE_URL, **kwargs):
+        super().__init__(base_url, **kwargs)
+
+    def build_params(self, query):
+        return {
+            "task": "affiliation-matching",
+            "input": query,
+            "strategy": "affiliation-single-search"
+        }
+
+    def parse_response(self, affiliation, api_response, verbose):
+        # None marks a response that should not be cached
+        if api_response["status"] != "ok":
+            return None
+        results = []
+        for item in api_response["message"]["items"]:
+            ror_id = item["id"]
+            confidence = item["confidence"]
+            results.append((ror_id, confidence))
+            if verbose:
+                logging.debug(f"Crossref Marple match found for '{affiliation}': {ror_id} (confidence: {confidence})")
+            break
+        if not results and verbose:
+            logging.debug(f"No Crossref Marple match found for '{affiliation}'")
+        return results
+
+
+class RorApiBackend(RemoteBackend):
+    name = 'ror'
+    query_param = 'affiliation'
+
+    def __init__(self, base_url=ROR_URL, **kwargs):
+        super().__init__(base_url, **kwargs)
+
+    def parse_response(self, affiliation, api_response, verbose):
+        results = []
+        for item in api_response.get('items', []):
+            if item.get('chosen'):
+                org_id = item['organization']['id']
+                score = item['score']
+                results.append((org_id, score))
+                if verbose:
+                    logging.debug(f"Match found for '{affiliation}': {org_id} (score: {score})")
+                break
+        if not results and verbose:
+            logging.debug(f"No match found for '{affiliation}' in initial query")
+        return results
+
+
+class LocalRorBackend:
+    name = 'ror'
+    remote = False
+
+    def __init__(self, ror_index):
+        self.ror_index = ror_index
+
+    def query(self, query, verbose=False):
+        try:
+            with metrics.timer('ror_index_match'):
+                results = self.ror_index.match(query)
+        except Exception as e:
+            logging.error(f'Error in local ROR index query: {query} - {e}')
+            return []
+        if verbose:
+            logging.debug(f"Local ROR index result for '{query}': {results}")
+        return results
+
+
+def add_backend_arguments(parser):
+    parser.add_argument('--marple-url', default=MARPLE_URL,
+                        help='Crossref Marple match endpoint')
+    parser.add_argument('--ror-url', default=ROR_URL,
+                        help='ROR API organizations endpoint')
+    parser.add_argument('--ror-index',
+                        help='Local ROR index (built with ror_index.py) used for fallback queries instead of the ROR API')
+    parser.add_argument('--rate-limit', type=rate_limit_spec, action='append', default=[],
+                        metavar='HOST=RPS', help='Maximum requests per second for a host (repeatable)')
+    parser.add_argument('--http-retries', type=int, default=3,
+                        help='Retries for failed or throttled API requests')
+    parser.add_argument('--http-backoff', type=float, default=0.5,
+                        help='Exponential backoff factor in seconds between retries')
+    parser.add_argument('--http-timeout', type=float, default=30,
+                        help='Timeout in seconds for each API request')
+    parser.add_argument('--record-fixtures',
+                        help='JSONL file to append every API response to, for replay with fixture_server.py')
+    parser.add_argument('--cache', help='SQLite file for caching Marple and ROR API responses')
+    parser.add_argument('--cache-ttl', type=float,
+                        help='Seconds before a cached response expires')
+    parser.add_argument('--cache-max-entries', type=int,
+                        help='Maximum number of cached responses to keep')
+
+
+def create_backends(args, pool_size=10):
+    session = create_session(pool_size=max(pool_size, 1), retries=args.http_retries,
+                             backoff_factor=args.http_backoff)
+    rate_limiter = HostRateLimiter(dict(args.rate_limit)) if args.rate_limit else None
+    cache = ResponseCache(args.cache, ttl=args.cache_ttl,
+                          max_entries=args.cache_max_entries) if args.cache else None
+    recorder = FixtureRecorder(args.record_fixtures) if args.record_fixtures else None
+    remote = {'session': session, 'rate_limiter': rate_limiter, 'cache': cache,
+              'recorder': recorder, 'timeout': args.http_timeout}
+    marple_backend = MarpleBackend(args.marple_url, **remote)
+    if args.ror_index:
+        ror_backend = LocalRorBackend(RorIndex.load(args.ror_index))
+    else:
+        ror_backend = RorApiBackend(args.ror_url, **remote)
+    return marple_backend, ror_backend
+
+
+def close_backends(*backends):
+    closed = set()
+    for backend in backends:
+        for resource in (getattr(backend, 'cache', None), getattr(backend, 'recorder', None)):
+            if resource is not None and id(resource) not in closed:
+                if isinstance(resource, ResponseCache):
+                    logging.info(f"Response cache stats: {resource.stats()}")
+                resource.close()
+                closed.add(id(resource))
+        session = getattr(backend, 'session', None)
+        if session is not None and id(session) not in closed:
+            session.close()
+            closed.add(id(session))
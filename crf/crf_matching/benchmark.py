@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+from tabulate import tabulate
+from compiled_crf import load_crf_model
+from utils import tokenize, create_dictionaries, build_gazetteer
+from backends import add_backend_arguments, create_backends, close_backends
+from fixture_server import load_fixtures, create_fixture_server
+from single_search_crf_fallback import STRATEGIES, FANOUT_RULES, parse_affiliation, parse_and_query, network_calls, positive_int
+from record_io import detect_format, open_text, record_reader
+from evaluate import evaluate_rows, read_results
+from instrumentation import metrics
+
+
+class TimedBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.latencies = []
+
+    def __getattr__(self, name):
+        # name, remote, cache and the rest come from the wrapped backend, so
+        # the cheapest strategy sees the same response cache as without it
+        return getattr(self.backend, name)
+
+    def query(self, query, verbose=False):
+        start = time.perf_counter()
+        results = self.backend.query(query, verbose)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies.append(elapsed)
+        return results
+
+
+def percentile(sorted_values, q):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(q / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def latency_summary(stage, latencies):
+    values = sorted(latencies)
+    return {
+        'Stage': stage,
+        'Calls': len(values),
+        'Mean (ms)': 1000 * sum(values) / len(values) if values else 0.0,
+        'p50 (ms)': 1000 * percentile(values, 50),
+        'p95 (ms)': 1000 * percentile(values, 95),
+        'p99 (ms)': 1000 * percentile(values, 99),
+    }
+
+
+def histogram_summary(stage, timer):
+    # Bucketed quantiles from the stage metrics, for latencies that are not
+    # timed call by call here
+    timer = timer or {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+    return {
+        'Stage': stage,
+        'Calls': timer['count'],
+        'Mean (ms)': 1000 * timer['mean'],
+        'p50 (ms)': 1000 * timer['p50'],
+        'p95 (ms)': 1000 * timer['p95'],
+        'p99 (ms)': 1000 * timer['p99'],
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def read_affiliations(input_file):
+    with open_text(input_file, 'r') as f:
+        _, records = record_reader(f, detect_format(input_file))
+        return [row['affiliation'] for row in records]
+
+
+def benchmark_crf(affiliations, crf_model, country_dict, institution_dict, address_dict, gazetteer=None):
+    latencies = []
+    n_tokens = 0
+    for affiliation in affiliations:
+        tokens = tokenize(affiliation)
+        if not tokens:
+            # Blank affiliations have nothing to parse
+            continue
+        n_tokens += len(tokens)
+        start = time.perf_counter()
+        parse_affiliation(affiliation, crf_model, country_dict,
+                          institution_dict, address_dict, False, gazetteer)
+        latencies.append(time.perf_counter() - start)
+    return latencies, n_tokens
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the matching pipeline against recorded API responses.')
+    parser.add_argument('-i', '--input', required=True,
+                        help='Input CSV with an affiliation column (and ror_id, to report accuracy)')
+    parser.add_argument('-f', '--fixtures', nargs='+',
+                        help='JSONL files written with --record-fixtures, replayed from an in-process server')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='Delay added to every replayed response, in milliseconds')
+    parser.add_argument('-m', '--model', help='Path to the trained CRF model file (.joblib, its memory-mapped .crfm copy, or .npz exported with --export_compiled)',
+                        default='model/affiliation_parser_crf_model.joblib')
+    parser.add_argument(
+        '-c', '--countries', help='File containing list of countries', default='data/countries.txt')
+    parser.add_argument('-n', '--institutions', help='File containing institution keywords',
+                        default='data/institution_keywords.txt')
+    parser.add_argument('-d', '--addresses', help='File containing address keywords',
+                        default='data/address_keywords.txt')
+    parser.add_argument('--gazetteer', action='store_true',
+                        help='Add multi-word dictionary match features (the model must be trained with --gazetteer)')
+    parser.add_argument('-w', '--workers', type=positive_int, default=1,
+                        help='Number of concurrent API queries')
+    parser.add_argument('--fallback-fanout', choices=FANOUT_RULES,
+                        help='Send all fallback queries of an affiliation at once and keep the first match in order or the best scoring one')
+    parser.add_argument('--fanout-workers', type=positive_int, default=8,
+                        help='Number of concurrent fallback queries with --fallback-fanout')
+    parser.add_argument('-b', '--batch-size', type=int, default=100,
+                        help='Number of rows resolved per batch')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Resolve each distinct affiliation once')
+    parser.add_argument('-s', '--strategies', nargs='+', choices=STRATEGIES, default=['marple-first'],
+                        help='Matching strategies to run; calls saved are reported against the first one')
+    parser.add_argument('-r', '--results', help='Output CSV for the matching results of the last strategy (default: a temporary file)')
+    parser.add_argument('-o', '--output', help='JSON file to write the benchmark report to')
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+    if 'parallel' in args.strategies and args.workers < 2:
+        parser.error("the parallel strategy needs -w/--workers of at least 2")
+    return args
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    server = None
+    if args.fixtures:
+        server = create_fixture_server(load_fixtures(args.fixtures), port=0,
+                                       latency=args.latency_ms / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        args.marple_url = f"{base_url}/match"
+        args.ror_url = f"{base_url}/organizations"
+        logging.info(f"Replaying {len(server.fixtures)} recorded responses from {base_url}")
+    crf_model = load_crf_model(args.model)
+    country_dict, institution_dict, address_dict = create_dictionaries(
+        args.countries, args.institutions, args.addresses)
+    gazetteer = build_gazetteer(
+        country_dict, institution_dict, address_dict) if args.gazetteer else None
+    pool_size = args.workers + (args.fanout_workers if args.fallback_fanout else 0)
+    marple_backend, ror_backend = create_backends(args, pool_size=pool_size)
+    results_file = args.results
+    if not results_file:
+        fd, results_file = tempfile.mkstemp(suffix='_results.csv')
+        os.close(fd)
+
+    affiliations = read_affiliations(args.input)
+    runs = []
+    try:
+        for strategy in args.strategies:
+            logging.info(f"Matching {len(affiliations)} affiliations with the {strategy} strategy "
+                         f"and {args.workers} workers...")
+            timed_marple, timed_ror = TimedBackend(marple_backend), TimedBackend(ror_backend)
+            metrics.reset()
+            calls_before = network_calls()
+            start = time.perf_counter()
+            parse_and_query(args.input, results_file, crf_model, country_dict, institution_dict,
+                            address_dict, False, workers=args.workers, batch_size=args.batch_size,
+                            marple_backend=timed_marple, ror_backend=timed_ror, dedupe=args.dedupe,
+                            gazetteer=gazetteer, checkpoint_every=0, strategy=strategy,
+                            fanout=args.fallback_fanout, fanout_workers=args.fanout_workers)
+            elapsed = time.perf_counter() - start
+            calls = {name: count - calls_before[name] for name, count in network_calls().items()}
+            run = {
+                'strategy': strategy,
+                'seconds': elapsed,
+                'rows_per_second': len(affiliations) / elapsed if elapsed else 0.0,
+                'marple_calls': calls['marple'],
+                'ror_calls': calls['ror'],
+                'calls_per_1k_rows': 1000 * sum(calls.values()) / len(affiliations) if affiliations else 0.0,
+                'stages': [latency_summary('Marple', timed_marple.latencies),
+                           latency_summary('ROR fallback', timed_ror.latencies),
+                           histogram_summary('Fallback per affiliation',
+                                             metrics.snapshot()['timers'].get('fallback_affiliation'))],
+            }
+            results = read_results(results_file)
+            if results and 'ror_id' in results[0]:
+                run['accuracy'], _ = evaluate_rows(results)
+            runs.append(run)
+    finally:
+        close_backends(marple_backend, ror_backend)
+        if server:
+            server.shutdown()
+            server.server_close()
+        if not args.results:
+            os.remove(results_file)
+    for run in runs:
+        run['calls_saved_per_1k_rows'] = runs[0]['calls_per_1k_rows'] - run['calls_per_1k_rows']
+
+    logging.info("Timing CRF parsing...")
+    crf_latencies, n_tokens = benchmark_crf(affiliations, crf_model, country_dict,
+                                            institution_dict, address_dict, gazetteer)
+    crf_seconds = sum(crf_latencies)
+    report = {
+        'rows': len(affiliations),
+        'crf_tokens_per_second': n_tokens / crf_seconds if crf_seconds else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+        'crf_parse': latency_summary('CRF parse', crf_latencies),
+        'runs': runs,
+    }
+
+    stages = [dict(Strategy=run['strategy'], **stage) for run in runs for stage in run['stages']]
+    stages.append(dict(Strategy='', **report['crf_parse']))
+    print(tabulate(stages, headers='keys', tablefmt='pipe', floatfmt='.3f'))
+    print()
+    summary = []
+    for run in runs:
+        row = {'Strategy': run['strategy'], 'Rows/sec': run['rows_per_second'],
+               'Marple calls': run['marple_calls'], 'ROR calls': run['ror_calls'],
+               'Calls/1k rows': run['calls_per_1k_rows'],
+               'Saved/1k rows': run['calls_saved_per_1k_rows']}
+        if 'accuracy' in run:
+            row.update({name: run['accuracy'][name] for name in ('Precision', 'Recall', 'F1 Score')})
+        summary.append(row)
+    print(tabulate(summary, headers='keys', tablefmt='pipe', floatfmt='.4f'))
+    print()
+    print(tabulate([{'Rows': report['rows'], 'CRF tokens/sec': report['crf_tokens_per_second'],
+                     'Peak RSS (MB)': report['peak_rss_mb']}], headers='keys', tablefmt='pipe', floatfmt='.1f'))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import csv
+import glob
+import time
+import logging
+import argparse
+from tabulate import tabulate
+from ror_index import RorIndex
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Compare local ROR index matches against the ROR API results stored in results CSVs.')
+    parser.add_argument('-x', '--ror-index', required=True,
+                        help='Local ROR index built with ror_index.py')
+    parser.add_argument('-r', '--results', nargs='+', default=sorted(glob.glob('results/*_results.csv')),
+                        help='Results CSVs with fallback_queries, predicted_ror_id and ror_id columns')
+    parser.add_argument('-o', '--output', help='CSV file to write the per-row comparison to')
+    return parser.parse_args()
+
+
+def run_fallback_queries(ror_index, fallback_queries):
+    # Same order and stopping rule as execute_fallback_query
+    for query in fallback_queries.split('; '):
+        results = ror_index.match(query)
+        if results:
+            return results
+    return []
+
+
+def compare_results_file(ror_index, file_path, comparison_rows):
+    summary = {'dataset': file_path, 'rows': 0, 'api_matched': 0, 'local_matched': 0,
+               'agreement': 0, 'api_correct': 0, 'local_correct': 0, 'queries': 0, 'seconds': 0.0}
+    with open(file_path, encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if not row.get('fallback_queries'):
+                continue
+            api_prediction = row['predicted_ror_id'] if row['match_type'] == 'crf_fallback' else ''
+            start = time.perf_counter()
+            results = run_fallback_queries(ror_index, row['fallback_queries'])
+            summary['seconds'] += time.perf_counter() - start
+            summary['queries'] += row['fallback_queries'].count('; ') + 1
+            local_prediction = ";".join(r[0] for r in results)
+            summary['rows'] += 1
+            summary['api_matched'] += bool(api_prediction)
+            summary['local_matched'] += bool(local_prediction)
+            summary['agreement'] += api_prediction == local_prediction
+            summary['api_correct'] += bool(api_prediction) and api_prediction == row['ror_id']
+            summary['local_correct'] += bool(local_prediction) and local_prediction == row['ror_id']
+            comparison_rows.append({'dataset': file_path, 'affiliation': row['affiliation'],
+                                    'ror_id': row['ror_id'], 'api_predicted_ror_id': api_prediction,
+                                    'local_predicted_ror_id': local_prediction,
+                                    'fallback_queries': row['fallback_queries']})
+    return summary
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    logging.info(f"Loading local ROR index from {args.ror_index}...")
+    ror_index = RorIndex.load(args.ror_index)
+    summaries = []
+    comparison_rows = []
+    for file_path in args.results:
+        summary = compare_results_file(ror_index, file_path, comparison_rows)
+        rows = summary['rows'] or 1
+        summaries.append({
+            'Dataset': summary['dataset'],
+            'Fallback rows': summary['rows'],
+            'Agreement': summary['agreement'] / rows,
+            'API matched': summary['api_matched'] / rows,
+            'Local matched': summary['local_matched'] / rows,
+            'API correct': summary['api_correct'] / rows,
+            'Local correct': summary['local_correct'] / rows,
+            'Local queries/sec': summary['queries'] / summary['seconds'] if summary['seconds'] else 0.0,
+        })
+    print(tabulate(summaries, headers='keys', tablefmt='pipe', floatfmt='.4f'))
+    if args.output and comparison_rows:
+        with open(args.output, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=list(comparison_rows[0]))
+            writer.writeheader()
+            writer.writerows(comparison_rows)
+
+
+if __name__ == '__main__':
+    main()
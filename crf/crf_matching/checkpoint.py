@@ -0,0 +1,32 @@
+import os
+import json
+
+
+def checkpoint_path(output_file):
+    return f"{output_file}.checkpoint.json"
+
+
+def load_checkpoint(output_file):
+    path = checkpoint_path(output_file)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def remove_checkpoint(output_file):
+    path = checkpoint_path(output_file)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def save_checkpoint(output_file, state):
+    # Written to a temporary file and renamed so a crash mid-write never
+    # leaves a truncated checkpoint behind
+    path = checkpoint_path(output_file)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
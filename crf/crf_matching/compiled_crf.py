@@ -0,0 +1,344 @@
+import os
+import json
+import struct
+import numpy as np
+from utils import token_attributes, gazetteer_tags, PREV1_KEYS, PREV2_KEYS, NEXT1_KEYS, NEXT2_KEYS
+
+
+CRFSUITE_MAGIC = b'lCRF'
+HEADER_FORMAT = '<4sI4s9I'
+FEATURE_FORMAT = '<IIId'
+STATE_FEATURE = 0
+# A token's own feature keys, in tokens2features order
+OWN_KEYS = ('bias', 'word.lower()', 'word.isdigit()', 'word.isupper()', 'word.islower()',
+            'word.istitle()', 'word.isnumber()', 'word.allupper()', 'word.alllower()',
+            'word.startupper()', 'word.iscountry()', 'word.isinstitution()', 'word.isaddress()')
+TOKEN_CACHE_SIZE = 100000
+# Memory-mapped model file: magic, format version and header length, a JSON
+# header with the labels, attributes and array layout, then the weight arrays
+MAPPED_SUFFIX = '.crfm'
+MAPPED_MAGIC = b'CRFMMAP\0'
+MAPPED_VERSION = 1
+MAPPED_PREFIX_FORMAT = '<8sIQ'
+MAPPED_ALIGNMENT = 64
+
+
+def read_cqdb(data, offset):
+    # CRFsuite stores labels and attributes in a constant quark database.
+    # Its backward array maps each ID to the record holding the string.
+    magic, _, _, _, n_entries, backward_offset = struct.unpack_from('<4s5I', data, offset)
+    if magic != b'CQDB':
+        raise ValueError(f"Expected a CQDB chunk at offset {offset}")
+    strings = [None] * n_entries
+    for i in range(n_entries):
+        (record_offset,) = struct.unpack_from('<I', data, offset + backward_offset + 4 * i)
+        value_id, key_size = struct.unpack_from('<II', data, offset + record_offset)
+        start = offset + record_offset + 8
+        strings[value_id] = data[start:start + key_size - 1].decode('utf-8')
+    return strings
+
+
+def read_crfsuite_model(data):
+    # state_features_ and transition_features_ on the sklearn_crfsuite model
+    # are parsed from a text dump rounded to 6 decimals, so the exact float64
+    # weights are read from the binary model file instead
+    (magic, _, _, _, _, n_labels, n_attributes, features_offset,
+     labels_offset, attributes_offset, _, _) = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic != CRFSUITE_MAGIC:
+        raise ValueError("Not a CRFsuite model file")
+    labels = read_cqdb(data, labels_offset)
+    attributes = read_cqdb(data, attributes_offset)
+    _, _, n_features = struct.unpack_from('<4sII', data, features_offset)
+    records = np.frombuffer(data, dtype=np.dtype([('type', '<u4'), ('src', '<u4'), ('dst', '<u4'), ('weight', '<f8')]),
+                            count=n_features, offset=features_offset + 12)
+    state = records[records['type'] == STATE_FEATURE]
+    transition = records[records['type'] != STATE_FEATURE]
+    state_weights = np.zeros((n_attributes, n_labels), dtype=np.float64)
+    state_weights[state['src'], state['dst']] = state['weight']
+    transitions = np.zeros((n_labels, n_labels), dtype=np.float64)
+    transitions[transition['src'], transition['dst']] = transition['weight']
+    return labels, attributes, state_weights, transitions
+
+
+def item_attributes(features):
+    # Same attribute names and values as python-crfsuite builds from a
+    # feature dict: strings become "key:value" with weight 1, numbers and
+    # bools keep their key, nested dicts and lists are prefixed with the key
+    if not isinstance(features, dict):
+        for key in features:
+            yield key, 1.0
+        return
+    for key, value in features.items():
+        if isinstance(value, (dict, list, set)):
+            for name, nested_value in item_attributes(value):
+                yield f"{key}:{name}", nested_value
+        elif isinstance(value, str):
+            yield f"{key}:{value}", 1.0
+        else:
+            yield key, float(value)
+
+
+class CompiledCRF:
+    def __init__(self, labels, attributes, state_weights, transitions):
+        self.labels = list(labels)
+        self.attributes = list(attributes)
+        self.attribute_ids = {name: i for i, name in enumerate(self.attributes)}
+        # "key:value" attributes are also indexed by every (key, value) split
+        # of their name, so string features are looked up without building
+        # the joined name. Feature keys such as "-1:word.lower()" contain
+        # colons themselves, and any split that matches rebuilds the same name.
+        self.value_attribute_ids = {}
+        for name, i in self.attribute_ids.items():
+            start = name.find(':')
+            while start != -1:
+                self.value_attribute_ids.setdefault(name[:start], {})[name[start + 1:]] = i
+                start = name.find(':', start + 1)
+        self.state_weights = np.ascontiguousarray(state_weights, dtype=np.float64)
+        self.transitions = np.ascontiguousarray(transitions, dtype=np.float64)
+        self.bos_id = self.attribute_ids.get('BOS')
+        self.eos_id = self.attribute_ids.get('EOS')
+        self.token_cache = {}
+        self.token_cache_key = None
+
+    @classmethod
+    def from_crf(cls, crf):
+        with open(crf.modelfile.name, 'rb') as f:
+            return cls(*read_crfsuite_model(f.read()))
+
+    @property
+    def classes_(self):
+        return self.labels
+
+    def encode(self, xseq, offset=0, positions=None, attribute_ids=None, values=None):
+        # Appends (token position, attribute ID, value) for every attribute of
+        # the sequence the model has weights for; unknown ones are dropped,
+        # as in CRFsuite
+        positions = [] if positions is None else positions
+        attribute_ids = [] if attribute_ids is None else attribute_ids
+        values = [] if values is None else values
+        value_lookup = self.value_attribute_ids
+        key_lookup = self.attribute_ids
+        no_values = {}
+        for position, features in enumerate(xseq, offset):
+            for key, value in features.items():
+                if type(value) is str:
+                    attribute_id = value_lookup.get(key, no_values).get(value)
+                    if attribute_id is not None:
+                        positions.append(position)
+                        attribute_ids.append(attribute_id)
+                        values.append(1.0)
+                elif isinstance(value, (dict, list, set)):
+                    for name, nested_value in item_attributes({key: value}):
+                        attribute_id = key_lookup.get(name)
+                        if attribute_id is not None:
+                            positions.append(position)
+                            attribute_ids.append(attribute_id)
+                            values.append(nested_value)
+                else:
+                    attribute_id = key_lookup.get(key)
+                    if attribute_id is not None:
+                        positions.append(position)
+                        attribute_ids.append(attribute_id)
+                        values.append(float(value))
+        return positions, attribute_ids, values
+
+    def scores_from_attributes(self, positions, attribute_ids, values, n_positions):
+        contributions = self.state_weights[np.array(attribute_ids, dtype=np.intp)]
+        if values is not None:
+            contributions *= np.array(values, dtype=np.float64)[:, None]
+        positions = np.array(positions, dtype=np.intp)
+        scores = np.empty((n_positions, len(self.labels)), dtype=np.float64)
+        # bincount adds the contributions of each token in attribute order,
+        # the same summation order as CRFsuite, so scores match bit for bit
+        for label in range(len(self.labels)):
+            scores[:, label] = np.bincount(positions, weights=contributions[:, label],
+                                           minlength=n_positions)
+        return scores
+
+    def state_scores(self, X):
+        lengths = np.array([len(xseq) for xseq in X], dtype=np.intp)
+        max_length = int(lengths.max()) if len(X) else 0
+        positions, attribute_ids, values = [], [], []
+        for i, xseq in enumerate(X):
+            self.encode(xseq, i * max_length, positions, attribute_ids, values)
+        scores = self.scores_from_attributes(positions, attribute_ids, values, len(X) * max_length)
+        return scores.reshape(len(X), max_length, len(self.labels)), lengths
+
+    def lookup_ids(self, keys, values):
+        # Every feature value tokens2features produces is a string, a bool or
+        # the 1.0 bias, so the weight of each present attribute is 1 and
+        # false ones can be left out
+        ids = []
+        for key, value in zip(keys, values):
+            if type(value) is str:
+                attribute_id = self.value_attribute_ids.get(key, {}).get(value)
+            else:
+                attribute_id = self.attribute_ids.get(key) if value else None
+            if attribute_id is not None:
+                ids.append(attribute_id)
+        return ids
+
+    def token_ids(self, token, country_dict, institution_dict, address_dict):
+        # IDs of the features a token produces for itself and as the -1, -2,
+        # +1 and +2 context of its neighbours
+        cache_key = (id(country_dict), id(institution_dict), id(address_dict))
+        if cache_key != self.token_cache_key or len(self.token_cache) >= TOKEN_CACHE_SIZE:
+            self.token_cache = {}
+            self.token_cache_key = cache_key
+        ids = self.token_cache.get(token)
+        if ids is None:
+            attributes = token_attributes(token, country_dict, institution_dict, address_dict)
+            (lower, isdigit, isupper, islower, istitle,
+             iscountry, isinstitution, isaddress, startupper) = attributes
+            own = self.lookup_ids(OWN_KEYS, (1.0, lower, isdigit, isupper, islower, istitle, isdigit,
+                                             isupper, islower, startupper, iscountry, isinstitution,
+                                             isaddress))
+            ids = (own,) + tuple(self.lookup_ids(keys, attributes)
+                                 for keys in (PREV1_KEYS, PREV2_KEYS, NEXT1_KEYS, NEXT2_KEYS))
+            self.token_cache[token] = ids
+        return ids
+
+    def encode_tokens(self, tokens, country_dict, institution_dict, address_dict, gazetteer=None,
+                      offset=0, positions=None, attribute_ids=None):
+        # Integer equivalent of tokens2features followed by encode
+        positions = [] if positions is None else positions
+        attribute_ids = [] if attribute_ids is None else attribute_ids
+        token_ids = [self.token_ids(token, country_dict, institution_dict, address_dict)
+                     for token in tokens]
+        gazetteer_spans = gazetteer_tags(tokens, gazetteer) if gazetteer else None
+        last = len(tokens) - 1
+        for i, (own, _, _, _, _) in enumerate(token_ids):
+            ids = list(own)
+            if i > 0:
+                ids.extend(token_ids[i - 1][1])
+            elif self.bos_id is not None:
+                ids.append(self.bos_id)
+            if i > 1:
+                ids.extend(token_ids[i - 2][2])
+            if i < last:
+                ids.extend(token_ids[i + 1][3])
+            elif self.eos_id is not None:
+                ids.append(self.eos_id)
+            if i < last - 1:
+                ids.extend(token_ids[i + 2][4])
+            if gazetteer_spans:
+                ids.extend(self.lookup_ids([f'word.{category}_gazetteer()' for category in gazetteer_spans[i]],
+                                           gazetteer_spans[i].values()))
+            positions.extend([offset + i] * len(ids))
+            attribute_ids.extend(ids)
+        return positions, attribute_ids
+
+    def viterbi(self, scores, lengths):
+        batch_size, max_length, n_labels = scores.shape
+        paths = np.zeros((batch_size, max_length), dtype=np.intp)
+        if not max_length:
+            return paths
+        backpointers = np.zeros((batch_size, max_length, n_labels), dtype=np.intp)
+        best = scores[:, 0].copy()
+        for t in range(1, max_length):
+            candidates = best[:, :, None] + self.transitions[None]
+            # argmax keeps the first (lowest ID) label on ties, like CRFsuite
+            backpointers[:, t] = candidates.argmax(axis=1)
+            step = candidates.max(axis=1) + scores[:, t]
+            active = lengths > t
+            best[active] = step[active]
+        current = best.argmax(axis=1)
+        rows = np.arange(batch_size)
+        for t in range(max_length - 1, -1, -1):
+            active = lengths > t
+            paths[active, t] = current[active]
+            if t:
+                current = np.where(active, backpointers[rows, t, current], current)
+        return paths
+
+    def decode(self, scores, lengths):
+        paths = self.viterbi(scores, lengths)
+        return [[self.labels[i] for i in path[:length]] for path, length in zip(paths, lengths)]
+
+    def predict(self, X):
+        X = list(X)
+        if not X:
+            return []
+        return self.decode(*self.state_scores(X))
+
+    def predict_single(self, xseq):
+        return self.predict([xseq])[0]
+
+    def predict_tokens(self, token_lists, country_dict, institution_dict, address_dict, gazetteer=None):
+        # Labels tokenized sequences directly, without building feature dicts.
+        # Same output as predict() on tokens2features of each sequence.
+        if not token_lists:
+            return []
+        lengths = np.array([len(tokens) for tokens in token_lists], dtype=np.intp)
+        max_length = int(lengths.max())
+        positions, attribute_ids = [], []
+        for i, tokens in enumerate(token_lists):
+            self.encode_tokens(tokens, country_dict, institution_dict, address_dict, gazetteer,
+                               i * max_length, positions, attribute_ids)
+        scores = self.scores_from_attributes(positions, attribute_ids, None, len(token_lists) * max_length)
+        return self.decode(scores.reshape(len(token_lists), max_length, len(self.labels)), lengths)
+
+    def save(self, file_path):
+        np.savez(file_path, labels=np.array(self.labels), attributes=np.array(self.attributes),
+                 state_weights=self.state_weights, transitions=self.transitions)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path, allow_pickle=False) as arrays:
+            return cls(arrays['labels'].tolist(), arrays['attributes'].tolist(),
+                       arrays['state_weights'], arrays['transitions'])
+
+    def save_mapped(self, file_path):
+        arrays = {'state_weights': self.state_weights, 'transitions': self.transitions}
+        header = {'labels': self.labels, 'attributes': self.attributes, 'arrays': {}}
+        # Offsets are relative to the end of the header, which is padded to
+        # the alignment so every array starts on an aligned boundary
+        offset = 0
+        for name, array in arrays.items():
+            header['arrays'][name] = {'offset': offset, 'shape': list(array.shape), 'dtype': '<f8'}
+            offset += -(-array.nbytes // MAPPED_ALIGNMENT) * MAPPED_ALIGNMENT
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = struct.calcsize(MAPPED_PREFIX_FORMAT) + len(header_bytes)
+        header_bytes += b' ' * (-data_start % MAPPED_ALIGNMENT)
+        # Written to a temporary file and renamed, so processes that have the
+        # old file mapped keep reading it intact
+        tmp_path = f'{file_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack(MAPPED_PREFIX_FORMAT, MAPPED_MAGIC, MAPPED_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            for name, array in arrays.items():
+                data = np.ascontiguousarray(array, dtype='<f8').tobytes()
+                f.write(data + b'\0' * (-len(data) % MAPPED_ALIGNMENT))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load_mapped(cls, file_path):
+        prefix_size = struct.calcsize(MAPPED_PREFIX_FORMAT)
+        with open(file_path, 'rb') as f:
+            magic, version, header_size = struct.unpack(MAPPED_PREFIX_FORMAT, f.read(prefix_size))
+            if magic != MAPPED_MAGIC:
+                raise ValueError(f"{file_path} is not a mapped CRF model file")
+            if version != MAPPED_VERSION:
+                raise ValueError(f"{file_path} has model file version {version}, expected {MAPPED_VERSION}")
+            header = json.loads(f.read(header_size))
+        data_start = prefix_size + header_size
+        arrays = {name: np.memmap(file_path, dtype=layout['dtype'], mode='r',
+                                  offset=data_start + layout['offset'], shape=tuple(layout['shape']))
+                  for name, layout in header['arrays'].items()}
+        return cls(header['labels'], header['attributes'], arrays['state_weights'], arrays['transitions'])
+
+
+def mapped_model_path(file_path):
+    return os.path.splitext(file_path)[0] + MAPPED_SUFFIX
+
+
+def load_crf_model(file_path):
+    if file_path.endswith(MAPPED_SUFFIX):
+        return CompiledCRF.load_mapped(file_path)
+    if file_path.endswith('.npz'):
+        return CompiledCRF.load(file_path)
+    # Only pickled models need joblib, and through it sklearn_crfsuite
+    import joblib
+    return joblib.load(file_path)
@@ -0,0 +1,131 @@
+import csv
+import sys
+import glob
+import logging
+import argparse
+from tabulate import tabulate
+
+
+METRIC_NAMES = ['Precision', 'Recall', 'F1 Score', 'F0.5 Score', 'Specificity']
+
+
+def parse_ids(value):
+    # Gold and predicted columns may hold several "; "-separated ROR IDs
+    return {ror_id.strip() for ror_id in (value or '').split(';') if ror_id.strip()}
+
+
+def confusion_counts(rows):
+    # A prediction is correct if every predicted ID is one of the gold IDs.
+    # A wrong prediction is only a false positive, not also a false negative.
+    counts = {'tp': 0, 'fp': 0, 'fn': 0, 'tn': 0}
+    for row in rows:
+        gold = parse_ids(row['ror_id'])
+        predicted = parse_ids(row['predicted_ror_id'])
+        if predicted:
+            counts['tp' if gold and predicted <= gold else 'fp'] += 1
+        elif gold:
+            counts['fn'] += 1
+        else:
+            counts['tn'] += 1
+    return counts
+
+
+def safe_divide(numerator, denominator):
+    return numerator / denominator if denominator else 0.0
+
+
+def f_beta(precision, recall, beta):
+    return safe_divide((1 + beta ** 2) * (precision * recall), (beta ** 2 * precision) + recall)
+
+
+def compute_metrics(counts):
+    precision = safe_divide(counts['tp'], counts['tp'] + counts['fp'])
+    recall = safe_divide(counts['tp'], counts['tp'] + counts['fn'])
+    return {
+        'Precision': precision,
+        'Recall': recall,
+        'F1 Score': f_beta(precision, recall, 1),
+        'F0.5 Score': f_beta(precision, recall, 0.5),
+        'Specificity': safe_divide(counts['tn'], counts['tn'] + counts['fp']),
+    }
+
+
+def evaluate_rows(rows):
+    by_match_type = {}
+    for row in rows:
+        by_match_type.setdefault(row.get('match_type', ''), []).append(row)
+    overall = compute_metrics(confusion_counts(rows))
+    breakdown = {match_type: dict(compute_metrics(confusion_counts(group)), rows=len(group))
+                 for match_type, group in sorted(by_match_type.items())}
+    return overall, breakdown
+
+
+def read_results(file_path):
+    with open(file_path, encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+def metrics_path(results_path):
+    return results_path.replace('_results.csv', '_metrics.csv')
+
+
+def write_metrics(file_path, metrics):
+    with open(file_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=METRIC_NAMES)
+        writer.writeheader()
+        writer.writerow(metrics)
+
+
+def check_metrics(file_path, metrics, tolerance=1e-9):
+    with open(file_path, encoding='utf-8') as f:
+        stored = next(csv.DictReader(f))
+    return [name for name in METRIC_NAMES if abs(float(stored[name]) - metrics[name]) > tolerance]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Compute Precision/Recall/F1/F0.5/Specificity for matching results CSVs.')
+    parser.add_argument('-r', '--results', nargs='+', default=sorted(glob.glob('results/*_results.csv')),
+                        help='Results CSVs with ror_id, predicted_ror_id and match_type columns')
+    parser.add_argument('-o', '--output', help='CSV file to write the per match_type breakdown to')
+    parser.add_argument('--write-metrics', action='store_true',
+                        help='Write <name>_metrics.csv next to each <name>_results.csv')
+    parser.add_argument('--check', action='store_true',
+                        help='Compare against the existing <name>_metrics.csv files and exit 1 on any difference')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    summaries = []
+    breakdown_rows = []
+    mismatches = 0
+    for file_path in args.results:
+        rows = read_results(file_path)
+        overall, breakdown = evaluate_rows(rows)
+        summaries.append(dict({'Dataset': file_path, 'match_type': 'all'}, **overall, rows=len(rows)))
+        for match_type, metrics in breakdown.items():
+            breakdown_rows.append(dict({'Dataset': file_path, 'match_type': match_type}, **metrics))
+        if args.write_metrics:
+            write_metrics(metrics_path(file_path), overall)
+        if args.check:
+            differences = check_metrics(metrics_path(file_path), overall)
+            if differences:
+                mismatches += 1
+                logging.error(f"{file_path}: {', '.join(differences)} differ from {metrics_path(file_path)}")
+            else:
+                logging.info(f"{file_path}: metrics match {metrics_path(file_path)}")
+    print(tabulate(summaries + breakdown_rows, headers='keys', tablefmt='pipe', floatfmt='.6f'))
+    if args.output and breakdown_rows:
+        with open(args.output, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=list(breakdown_rows[0]))
+            writer.writeheader()
+            writer.writerows(summaries + breakdown_rows)
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import json
+import time
+import logging
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from response_cache import normalize_query
+
+
+ENDPOINTS = {
+    '/match': ('marple', 'input', {"status": "ok", "message": {"items": []}}),
+    '/organizations': ('ror', 'affiliation', {"items": []}),
+}
+
+
+def load_fixtures(paths):
+    fixtures = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    fixtures[(entry['endpoint'], normalize_query(entry['query']))] = entry['response']
+    return fixtures
+
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            with server.lock:
+                self.send_json(200, dict(server.stats))
+            return
+        endpoint = next((ENDPOINTS[suffix] for suffix in ENDPOINTS if url.path.endswith(suffix)), None)
+        if endpoint is None:
+            self.send_json(404, {'error': f'Unknown endpoint: {url.path}'})
+            return
+        name, query_param, empty_response = endpoint
+        query = parse_qs(url.query).get(query_param, [''])[0]
+        response = server.fixtures.get((name, normalize_query(query)))
+        with server.lock:
+            server.stats['hits' if response is not None else 'misses'] += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if response is None and server.strict:
+            self.send_json(404, {'error': f'No recorded {name} response for: {query}'})
+            return
+        self.send_json(200, response if response is not None else empty_response)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def create_fixture_server(fixtures, host='127.0.0.1', port=8001, latency=0.0, strict=False):
+    server = FixtureServer((host, port), FixtureRequestHandler)
+    server.fixtures = fixtures
+    server.latency = latency
+    server.strict = strict
+    server.lock = threading.Lock()
+    server.stats = {'hits': 0, 'misses': 0}
+    return server
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Replay recorded Marple and ROR API responses from a local server.')
+    parser.add_argument('-f', '--fixtures', nargs='+', required=True,
+                        help='JSONL files written with --record-fixtures')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to bind to')
+    parser.add_argument('-p', '--port', type=int, default=8001, help='Port to listen on')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='Delay added to every response, in milliseconds')
+    parser.add_argument('--strict', action='store_true',
+                        help='Return 404 for queries without a recorded response instead of an empty result')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    fixtures = load_fixtures(args.fixtures)
+    server = create_fixture_server(fixtures, args.host, args.port,
+                                   latency=args.latency_ms / 1000, strict=args.strict)
+    base_url = f"http://{args.host}:{server.server_address[1]}"
+    logging.info(f"Replaying {len(fixtures)} recorded responses. Use "
+                 f"--marple-url {base_url}/match --ror-url {base_url}/organizations")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import requests
+
+
+class MatchingClient:
+    def __init__(self, base_url='http://127.0.0.1:8000', timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _get(self, path):
+        r = self.session.get(f"{self.base_url}{path}", timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def _post(self, path, affiliations):
+        r = self.session.post(f"{self.base_url}{path}", json={'affiliations': list(affiliations)},
+                              timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()['items']
+
+    def parse(self, affiliations):
+        return self._post('/parse', affiliations)
+
+    def match(self, affiliations):
+        return self._post('/match', affiliations)
+
+    def health(self):
+        return self._get('/health')
+
+    def metrics(self):
+        return self._get('/metrics')
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,256 @@
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from compiled_crf import load_crf_model
+from utils import create_dictionaries, build_gazetteer
+from backends import add_backend_arguments, create_backends, close_backends
+from instrumentation import metrics as stage_metrics
+from parse_cache import ParseCache
+from single_search_crf_fallback import (STRATEGIES, FANOUT_RULES, CascadeStats, parse_affiliations_batch,
+                                         positive_int, resolve_affiliations, format_outcome)
+
+
+class ServiceMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, n_affiliations, seconds, error=False):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'errors': 0, 'affiliations': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['affiliations'] += n_affiliations
+            stats['seconds'] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            endpoints = {name: dict(stats, mean_latency=stats['seconds'] / stats['requests'])
+                         for name, stats in self.endpoints.items()}
+        return {'uptime_seconds': time.time() - self.started, 'endpoints': endpoints}
+
+
+class MatchingService:
+    def __init__(self, crf_model, country_dict, institution_dict, address_dict, gazetteer=None,
+                 workers=8, marple_backend=None, ror_backend=None, max_batch_size=1000, parse_cache=None,
+                 strategy='marple-first', fanout=None, fanout_workers=8, max_request_bytes=16 << 20):
+        self.crf_model = crf_model
+        self.dictionaries = (country_dict, institution_dict, address_dict)
+        self.gazetteer = gazetteer
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.marple_backend = marple_backend
+        self.ror_backend = ror_backend
+        self.cache = getattr(marple_backend, 'cache', None)
+        self.max_batch_size = max_batch_size
+        self.max_request_bytes = max_request_bytes
+        self.parse_cache = parse_cache
+        self.strategy = strategy
+        self.cascade_stats = CascadeStats() if strategy == 'cheapest' else None
+        self.fanout = fanout
+        self.fanout_executor = ThreadPoolExecutor(max_workers=fanout_workers) if fanout else None
+        self.metrics = ServiceMetrics()
+
+    def parse(self, affiliations):
+        parsed = parse_affiliations_batch(affiliations, self.crf_model, *self.dictionaries,
+                                          gazetteer=self.gazetteer, parse_cache=self.parse_cache)
+        return [{'affiliation': affiliation, 'institutions': institutions,
+                 'addresses': addresses, 'countries': countries}
+                for affiliation, (institutions, addresses, countries) in zip(affiliations, parsed)]
+
+    def match(self, affiliations):
+        outcomes = resolve_affiliations(affiliations, self.crf_model, *self.dictionaries, False,
+                                        executor=self.executor, marple_backend=self.marple_backend,
+                                        ror_backend=self.ror_backend, gazetteer=self.gazetteer,
+                                        parse_cache=self.parse_cache, strategy=self.strategy,
+                                        fanout=self.fanout, fanout_executor=self.fanout_executor,
+                                        cascade_stats=self.cascade_stats)
+        return [dict(affiliation=affiliation, **format_outcome(*outcome))
+                for affiliation, outcome in zip(affiliations, outcomes)]
+
+    def status(self):
+        metrics = self.metrics.snapshot()
+        metrics['stages'] = stage_metrics.snapshot()
+        if self.cache:
+            metrics['cache'] = self.cache.stats()
+        if self.parse_cache:
+            metrics['parse_cache'] = self.parse_cache.stats()
+        if self.cascade_stats:
+            metrics['cascade'] = self.cascade_stats.snapshot()
+        return metrics
+
+    def close(self):
+        for executor in (self.executor, self.fanout_executor):
+            if executor:
+                executor.shutdown()
+        close_backends(self.marple_backend, self.ror_backend)
+
+
+class MatchingRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self.send_json(200, self.server.service.status())
+        elif self.path == '/metrics/prometheus':
+            payload = stage_metrics.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        else:
+            self.send_json(404, {'error': f'Unknown endpoint: {self.path}'})
+
+    def read_body(self, max_bytes):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if 'Transfer-Encoding' in self.headers or not 0 <= length <= max_bytes:
+            # An unread body would be parsed as the next request on this
+            # keep-alive connection, so it is closed instead
+            self.close_connection = True
+            if length > max_bytes:
+                raise ValueError(f"Request body is larger than {max_bytes} bytes")
+            raise ValueError("Request needs a valid Content-Length header")
+        return self.rfile.read(length)
+
+    def do_POST(self):
+        service = self.server.service
+        handlers = {'/parse': service.parse, '/match': service.match}
+        start = time.perf_counter()
+        affiliations = []
+        try:
+            data = self.read_body(service.max_request_bytes)
+        except ValueError as e:
+            if self.path in handlers:
+                service.metrics.record(self.path, 0, time.perf_counter() - start, error=True)
+            self.send_json(400, {'error': str(e)})
+            return
+        if self.path not in handlers:
+            self.send_json(404, {'error': f'Unknown endpoint: {self.path}'})
+            return
+        try:
+            body = json.loads(data or b'{}')
+            if not isinstance(body, dict):
+                raise ValueError("request body must be a JSON object")
+            affiliations = body.get('affiliations')
+            if not isinstance(affiliations, list) or not all(isinstance(a, str) for a in affiliations):
+                raise ValueError("'affiliations' must be a list of strings")
+            if len(affiliations) > service.max_batch_size:
+                raise ValueError(f"At most {service.max_batch_size} affiliations per request")
+        except ValueError as e:
+            service.metrics.record(self.path, 0, time.perf_counter() - start, error=True)
+            self.send_json(400, {'error': str(e)})
+            return
+        try:
+            items = handlers[self.path](affiliations)
+        except Exception as e:
+            logging.error(f'Error handling {self.path} request: {e}')
+            service.metrics.record(self.path, len(affiliations), time.perf_counter() - start, error=True)
+            self.send_json(500, {'error': str(e)})
+            return
+        service.metrics.record(self.path, len(affiliations), time.perf_counter() - start)
+        self.send_json(200, {'items': items})
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+class MatchingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def create_server(service, host='127.0.0.1', port=8000):
+    server = MatchingServer((host, port), MatchingRequestHandler)
+    server.service = service
+    return server
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Serve affiliation parsing and ROR matching over HTTP/JSON.')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to bind to')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('-m', '--model', help='Path to the trained CRF model file (.joblib, its memory-mapped .crfm copy, or .npz exported with --export_compiled)',
+                        default='model/affiliation_parser_crf_model.joblib')
+    parser.add_argument(
+        '-c', '--countries', help='File containing list of countries', default='data/countries.txt')
+    parser.add_argument('-n', '--institutions', help='File containing institution keywords',
+                        default='data/institution_keywords.txt')
+    parser.add_argument('-d', '--addresses', help='File containing address keywords',
+                        default='data/address_keywords.txt')
+    parser.add_argument('--gazetteer', action='store_true',
+                        help='Add multi-word dictionary match features (the model must be trained with --gazetteer)')
+    parser.add_argument('-w', '--workers', type=positive_int, default=8,
+                        help='Number of concurrent API queries per request')
+    parser.add_argument('--parse-cache-size', type=int, default=10000,
+                        help='Number of CRF parses kept in an in-memory LRU cache (0 disables it)')
+    parser.add_argument('--strategy', choices=STRATEGIES, default='marple-first',
+                        help='Order in which Crossref Marple and the CRF fallback are tried for each affiliation')
+    parser.add_argument('--fallback-fanout', choices=FANOUT_RULES,
+                        help='Send all fallback queries of an affiliation at once and keep the first match in order or the best scoring one')
+    parser.add_argument('--fanout-workers', type=positive_int, default=8,
+                        help='Number of concurrent fallback queries with --fallback-fanout')
+    parser.add_argument('--max-batch-size', type=int, default=1000,
+                        help='Maximum number of affiliations per request')
+    parser.add_argument('--max-request-bytes', type=int, default=16 << 20,
+                        help='Maximum size of a request body in bytes')
+    add_backend_arguments(parser)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Enable verbose logging')
+    args = parser.parse_args()
+    if args.strategy == 'parallel' and args.workers < 2:
+        parser.error("--strategy parallel needs -w/--workers of at least 2")
+    return args
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    logging.info("Loading CRF model and dictionaries...")
+    crf_model = load_crf_model(args.model)
+    country_dict, institution_dict, address_dict = create_dictionaries(
+        args.countries, args.institutions, args.addresses)
+    gazetteer = build_gazetteer(
+        country_dict, institution_dict, address_dict) if args.gazetteer else None
+    pool_size = args.workers + (args.fanout_workers if args.fallback_fanout else 0)
+    marple_backend, ror_backend = create_backends(args, pool_size=pool_size)
+    service = MatchingService(crf_model, country_dict, institution_dict, address_dict,
+                              gazetteer=gazetteer, workers=args.workers, marple_backend=marple_backend,
+                              ror_backend=ror_backend, max_batch_size=args.max_batch_size,
+                              parse_cache=ParseCache(args.parse_cache_size) if args.parse_cache_size > 0 else None,
+                              strategy=args.strategy, fanout=args.fallback_fanout,
+                              fanout_workers=args.fanout_workers, max_request_bytes=args.max_request_bytes)
+    server = create_server(service, args.host, args.port)
+    logging.info(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import logging
+import argparse
+from record_io import detect_format, exit_on_broken_pipe, open_text, record_reader, RecordWriter
+
+
+def merge_shards(shard_files, output_file):
+    # Shard I holds input rows I, I+N, I+2N, ..., so taking one row from each
+    # shard in turn restores the input order
+    handles = [open_text(path, 'r') for path in shard_files]
+    try:
+        readers = [record_reader(f, detect_format(path)) for path, f in zip(shard_files, handles)]
+        fieldnames = readers[0][0]
+        for path, (shard_fieldnames, _) in zip(shard_files, readers):
+            if shard_fieldnames and shard_fieldnames != fieldnames:
+                raise ValueError(f"{path} has different columns from {shard_files[0]}")
+        total_rows = 0
+        with open_text(output_file, 'w') as f_out:
+            writer = RecordWriter(f_out, detect_format(output_file), fieldnames)
+            writer.write_header()
+            active = [records for _, records in readers]
+            while active:
+                remaining = []
+                for records in active:
+                    row = next(records, None)
+                    if row is None:
+                        continue
+                    writer.write(row)
+                    total_rows += 1
+                    remaining.append(records)
+                active = remaining
+            writer.flush()
+    finally:
+        for f in handles:
+            f.close()
+    return total_rows
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Merge the outputs of a sharded run back into input order.')
+    parser.add_argument('-i', '--inputs', nargs='+', required=True,
+                        help='Shard output files (CSV or JSONL, optionally compressed), in shard order (0/N first)')
+    parser.add_argument('-o', '--output', default='ror-affiliation_results.csv',
+                        help='Merged output file (CSV or JSONL, optionally compressed, or - for stdout)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        total_rows = merge_shards(args.inputs, args.output)
+    except BrokenPipeError:
+        exit_on_broken_pipe()
+    logging.info(f"Merged {total_rows} rows from {len(args.inputs)} shards into {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import threading
+from collections import OrderedDict
+from response_cache import normalize_query
+from instrumentation import metrics
+
+
+class LRUCache:
+    def __init__(self, max_entries, name):
+        self.max_entries = max_entries
+        self.name = name
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+        metrics.increment(f'{self.name}_hit' if value is not None else f'{self.name}_miss')
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class ParseCache(LRUCache):
+    # Tokenization ignores whitespace, so affiliations that differ only in
+    # whitespace parse identically and share an entry. Wider normalization
+    # (case, punctuation) would change the tokens or their features.
+    def __init__(self, max_entries=10000):
+        super().__init__(max_entries, 'parse_cache')
+
+    def get(self, affiliation):
+        return super().get(normalize_query(affiliation))
+
+    def set(self, affiliation, parsed):
+        super().set(normalize_query(affiliation), parsed)
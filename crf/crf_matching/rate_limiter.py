@@ -0,0 +1,37 @@
+import time
+import argparse
+import threading
+from urllib.parse import urlparse
+
+
+class HostRateLimiter:
+    def __init__(self, limits):
+        self.intervals = {host: 1.0 / rate for host,
+                          rate in limits.items() if rate > 0}
+        self.next_allowed = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlparse(url).hostname
+        interval = self.intervals.get(host)
+        if interval is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_allowed.get(host, now))
+            self.next_allowed[host] = slot + interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def rate_limit_spec(spec):
+    host, sep, rate = spec.partition('=')
+    try:
+        rate = float(rate)
+    except ValueError:
+        rate = None
+    if not sep or not host.strip() or rate is None or rate <= 0:
+        raise argparse.ArgumentTypeError(
+            f"Invalid rate limit '{spec}', expected HOST=REQUESTS_PER_SECOND")
+    return host.strip(), rate
@@ -0,0 +1,125 @@
+import os
+import csv
+import sys
+import json
+import gzip
+import logging
+from itertools import chain
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+STDIO = '-'
+COMPRESSION_SUFFIXES = ('.gz', '.zst')
+FORMATS = ('csv', 'jsonl')
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    name = path
+    for suffix in COMPRESSION_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def is_plain_file(path):
+    # Only plain files can be seeked and truncated to resume from a checkpoint
+    return path != STDIO and not path.endswith(COMPRESSION_SUFFIXES)
+
+
+def exit_on_broken_pipe():
+    # The reader of stdout went away, e.g. `| head`. stdout is pointed at
+    # devnull so the interpreter's final flush does not fail again.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    sys.exit(0)
+
+
+def open_text(path, mode='r', buffer_size=1 << 20):
+    encoding = 'utf-8-sig' if mode == 'r' else 'utf-8'
+    if path == STDIO:
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return open(stream.fileno(), mode, encoding=encoding, newline='', closefd=False,
+                    buffering=buffer_size)
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding=encoding, newline='')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError(f"Reading or writing {path} requires the zstandard package")
+        return zstandard.open(path, mode + 't', encoding=encoding, newline='')
+    return open(path, mode, encoding=encoding, newline='', buffering=buffer_size)
+
+
+def record_reader(f, fmt):
+    # Returns the field names and a generator over the records. JSONL field
+    # names are taken from the first record; keys that only appear in later
+    # records are kept by the JSONL writer.
+    if fmt == 'jsonl':
+        records = (json.loads(line) for line in f if line.strip())
+        first = next(records, None)
+        if first is None:
+            return [], iter(())
+        return list(first), chain([first], records)
+    reader = csv.DictReader(f)
+    return list(reader.fieldnames or []), iter(reader)
+
+
+class RecordWriter:
+    def __init__(self, f, fmt, fieldnames, buffer_rows=1000):
+        self.f = f
+        self.fmt = fmt
+        self.fieldnames = fieldnames
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+            self.columns = set(fieldnames)
+            self.dropped = set()
+
+    def write_header(self):
+        if self.fmt == 'csv':
+            self.writer.writeheader()
+
+    def write(self, row):
+        if self.fmt == 'csv' and not self.columns.issuperset(row):
+            self.warn_dropped(row)
+        self.buffer.append(row)
+        if len(self.buffer) >= self.buffer_rows:
+            self.write_buffer()
+
+    def warn_dropped(self, row):
+        # CSV columns are fixed by the header, so keys that first appear in a
+        # later JSONL record cannot be written
+        for name in row.keys() - self.columns - self.dropped:
+            if name is not None:
+                logging.warning(f"Field '{name}' is not in the first input record and is dropped "
+                                f"from the CSV output; write JSONL output to keep it")
+            self.dropped.add(name)
+
+    def json_record(self, row):
+        # Every field name is written, followed by any keys the first record
+        # did not have. None holds the extra values of a CSV row with more
+        # fields than its header.
+        record = dict.fromkeys(self.fieldnames)
+        record.update(row)
+        record.pop(None, None)
+        return record
+
+    def write_buffer(self):
+        if not self.buffer:
+            return
+        if self.fmt == 'csv':
+            self.writer.writerows(self.buffer)
+        else:
+            self.f.write(''.join(json.dumps(self.json_record(row), ensure_ascii=False) + '\n'
+                                 for row in self.buffer))
+        self.buffer = []
+
+    def flush(self):
+        self.write_buffer()
+        self.f.flush()
@@ -0,0 +1,98 @@
+import json
+import time
+import sqlite3
+import threading
+
+
+def normalize_query(query):
+    return ' '.join(query.split())
+
+
+class ResponseCache:
+    def __init__(self, path, ttl=None, max_entries=None, evict_interval=100):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_interval = evict_interval
+        self.hits = 0
+        self.misses = 0
+        self.writes_since_evict = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, value TEXT NOT NULL,
+            created REAL NOT NULL, accessed REAL NOT NULL)''')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.conn.commit()
+
+    def make_key(self, endpoint, query):
+        return f"{endpoint}\t{normalize_query(query)}"
+
+    def get(self, endpoint, query):
+        key = self.make_key(endpoint, query)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row and self.ttl is not None and now - row[1] > self.ttl:
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.conn.commit()
+        return [tuple(result) for result in json.loads(row[0])]
+
+    def peek(self, endpoint, query):
+        # Like get, without counting a hit or miss or refreshing the entry
+        key = self.make_key(endpoint, query)
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            return None
+        return [tuple(result) for result in json.loads(row[0])]
+
+    def set(self, endpoint, query, results):
+        key = self.make_key(endpoint, query)
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                              (key, json.dumps(results), now, now))
+            self.conn.commit()
+            self.writes_since_evict += 1
+            if self.writes_since_evict >= self.evict_interval:
+                self._evict()
+
+    def _evict(self):
+        self.writes_since_evict = 0
+        if self.ttl is not None:
+            self.conn.execute('DELETE FROM responses WHERE created < ?',
+                              (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            count = self.conn.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute('''DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY accessed LIMIT ?)''',
+                                  (count - self.max_entries,))
+        self.conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self.lock:
+            self._evict()
+            self.conn.close()
@@ -0,0 +1,219 @@
+import json
+import math
+import gzip
+import pickle
+import zipfile
+import logging
+import argparse
+import unicodedata
+from collections import Counter, defaultdict
+from utils import tokenize
+
+
+COUNTRY_ALIASES = {
+    'usa': 'US', 'us': 'US', 'u s a': 'US', 'u s': 'US', 'united states of america': 'US',
+    'uk': 'GB', 'u k': 'GB', 'england': 'GB', 'scotland': 'GB', 'wales': 'GB',
+    'northern ireland': 'GB', 'great britain': 'GB',
+    'p r china': 'CN', 'pr china': 'CN', 'peoples republic of china': 'CN',
+    'people s republic of china': 'CN', 'korea': 'KR', 'south korea': 'KR',
+    'republic of korea': 'KR', 'russia': 'RU', 'russian federation': 'RU',
+}
+
+
+def fold_text(text):
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def normalize_name(text):
+    return ' '.join(token.lower() for token in tokenize(fold_text(text)) if token.isalnum())
+
+
+def char_ngrams(text, n=3):
+    padded = f" {text} "
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def load_ror_dump(path):
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            member = next(name for name in archive.namelist() if name.endswith('.json'))
+            with archive.open(member) as f:
+                return json.load(f)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def record_names(record):
+    if 'names' in record:
+        return [name['value'] for name in record['names'] if 'value' in name]
+    names = [record.get('name', '')] + record.get('aliases', []) + record.get('acronyms', [])
+    names.extend(label['label'] for label in record.get('labels', []))
+    return [name for name in names if name]
+
+
+def record_countries(record):
+    if 'locations' in record:
+        details = [location.get('geonames_details', {}) for location in record['locations']]
+    else:
+        details = [record.get('country', {})]
+    countries = set()
+    for detail in details:
+        code = detail.get('country_code')
+        if code:
+            countries.add((code.upper(), normalize_name(detail.get('country_name', ''))))
+    return countries
+
+
+class RorIndex:
+    def __init__(self, min_score=0.8, max_candidates=50, max_ngram_df=5000, max_token_df=5000):
+        self.min_score = min_score
+        self.max_candidates = max_candidates
+        self.max_ngram_df = max_ngram_df
+        self.max_token_df = max_token_df
+        self.names = []
+        self.name_ids = []
+        self.org_countries = {}
+        self.country_codes = dict(COUNTRY_ALIASES)
+        self.token_postings = defaultdict(list)
+        self.ngram_postings = defaultdict(list)
+        self.token_idf = {}
+
+    @classmethod
+    def from_records(cls, records, **kwargs):
+        index = cls(**kwargs)
+        for record in records:
+            if record.get('status', 'active') != 'active':
+                continue
+            index.add_record(record)
+        index.finalize()
+        return index
+
+    def add_record(self, record):
+        ror_id = record['id']
+        countries = record_countries(record)
+        self.org_countries[ror_id] = {code for code, _ in countries}
+        for code, country_name in countries:
+            self.country_codes.setdefault(code.lower(), code)
+            if country_name:
+                self.country_codes.setdefault(country_name, code)
+        for name in set(normalize_name(name) for name in record_names(record)):
+            if not name:
+                continue
+            name_id = len(self.names)
+            self.names.append(name)
+            self.name_ids.append(ror_id)
+            for token in set(name.split()):
+                self.token_postings[token].append(name_id)
+            for ngram in char_ngrams(name):
+                self.ngram_postings[ngram].append(name_id)
+
+    def finalize(self):
+        n_names = len(self.names) or 1
+        self.token_idf = {token: math.log(n_names / len(postings))
+                          for token, postings in self.token_postings.items()}
+        self.token_postings = dict(self.token_postings)
+        self.ngram_postings = dict(self.ngram_postings)
+
+    def split_country(self, query):
+        # Fallback queries are built as "<institution>, <country>"
+        institution, sep, country = query.rpartition(',')
+        if sep:
+            code = self.country_codes.get(normalize_name(country))
+            if code:
+                return institution, code
+        return query, None
+
+    def candidates(self, name, country_code=None):
+        tokens = [token for token in set(name.split()) if token in self.token_postings]
+        # Common tokens like "of" or "university" have long postings. They
+        # only add to the score of names found through a rarer token, unless
+        # the query has nothing rarer.
+        rare = [token for token in tokens if len(self.token_postings[token]) <= self.max_token_df]
+        if not rare and tokens:
+            rare = [min(tokens, key=lambda token: len(self.token_postings[token]))]
+        scores = Counter()
+        for token in rare:
+            for name_id in self.token_postings[token]:
+                scores[name_id] += self.token_idf[token]
+        common = {token: self.token_idf[token] for token in tokens if token not in rare}
+        if common:
+            for name_id in scores:
+                scores[name_id] += sum(common.get(token, 0.0) for token in set(self.names[name_id].split()))
+        # The country filter runs before the candidates are cut to
+        # max_candidates, so names shared by many organizations keep the one
+        # in the right country
+        scores = self.filter_country(scores, country_code)
+        if not scores:
+            for ngram in char_ngrams(name):
+                postings = self.ngram_postings.get(ngram, ())
+                if len(postings) <= self.max_ngram_df:
+                    scores.update(postings)
+            scores = self.filter_country(scores, country_code)
+        return [name_id for name_id, _ in scores.most_common(self.max_candidates)]
+
+    def filter_country(self, scores, country_code):
+        if not country_code:
+            return scores
+        return Counter({name_id: score for name_id, score in scores.items()
+                        if country_code in self.org_countries.get(self.name_ids[name_id], ())})
+
+    def match(self, query):
+        institution, country_code = self.split_country(query)
+        name = normalize_name(institution)
+        if not name:
+            return []
+        query_ngrams = char_ngrams(name)
+        best = None
+        for name_id in self.candidates(name, country_code):
+            ror_id = self.name_ids[name_id]
+            candidate_ngrams = char_ngrams(self.names[name_id])
+            score = 2 * len(query_ngrams & candidate_ngrams) / (len(query_ngrams) + len(candidate_ngrams))
+            if best is None or score > best[1] or (score == best[1] and ror_id < best[0]):
+                best = (ror_id, score)
+        if best and best[1] >= self.min_score:
+            return [(best[0], round(best[1], 4))]
+        return []
+
+    def save(self, file_path):
+        # Only plain containers are pickled, so the file loads regardless of
+        # which module the class was imported from
+        with gzip.open(file_path, 'wb') as f:
+            pickle.dump(vars(self), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, file_path):
+        index = cls()
+        with gzip.open(file_path, 'rb') as f:
+            vars(index).update(pickle.load(f))
+        return index
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Build a local ROR index from a ROR data dump.')
+    parser.add_argument('-i', '--input', required=True,
+                        help='ROR data dump (.json, .json.gz or the .zip release)')
+    parser.add_argument('-o', '--output', default='ror_index.pkl.gz',
+                        help='Output file for the index')
+    parser.add_argument('--min-score', type=float, default=0.8,
+                        help='Minimum similarity for a match to be chosen')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    logging.info(f"Loading ROR data dump from {args.input}...")
+    records = load_ror_dump(args.input)
+    logging.info(f"Indexing {len(records)} records...")
+    index = RorIndex.from_records(records, min_score=args.min_score)
+    logging.info(f"Indexed {len(index.names)} names for {len(index.org_countries)} organizations")
+    index.save(args.output)
+    logging.info(f"Saved index to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,28 @@
+import os
 import re
-import csv
+import time
+import cProfile
 import logging
 import argparse
-import joblib
-import requests
+import threading
 from datetime import datetime
-from urllib.parse import quote
-from utils import tokenize, create_dictionaries, extract_features
+from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from compiled_crf import CompiledCRF, load_crf_model
+from utils import tokenize, create_dictionaries, build_gazetteer, tokens2features
+from backends import MarpleBackend, RorApiBackend, add_backend_arguments, create_backends, close_backends
+from checkpoint import load_checkpoint, remove_checkpoint, save_checkpoint
+from instrumentation import metrics
+from parse_cache import LRUCache, ParseCache
+from record_io import FORMATS, detect_format, exit_on_broken_pipe, is_plain_file, open_text, record_reader, RecordWriter
+
+
+crf_lock = threading.Lock()
+backend_lock = threading.Lock()
+default_backends = {}
+STRATEGIES = ('marple-first', 'crf-first', 'cheapest', 'parallel', 'crf-only')
+FANOUT_RULES = ('first', 'best')
 
 
 def setup_logging(verbose):
@@ -17,42 +33,77 @@ def setup_logging(verbose):
                         format='%(asctime)s %(levelname)s %(message)s')
 
 
-def query_marple(affiliation, verbose):
-    results = []
-    try:
-        base_url = "https://marple.research.crossref.org/match"
-        params = {
-            "task": "affiliation-matching",
-            "input": quote(affiliation),
-            "strategy": "affiliation-single-search"
-        }
-        url = f"{base_url}?{'&'.join([f'{k}={v}' for k, v in params.items()])}"
-        r = requests.get(url)
-        api_response = r.json()
-
-        if api_response["status"] == "ok":
-            items = api_response["message"]["items"]
-            for item in items:
-                ror_id = item["id"]
-                confidence = item["confidence"]
-                results.append((ror_id, confidence))
-                if verbose:
-                    logging.debug(f"Crossref Marple match found for '{affiliation}': {ror_id} (confidence: {confidence})")
-                break
-        if not results and verbose:
-            logging.debug(f"No Crossref Marple match found for '{affiliation}'")
-    except Exception as e:
-        logging.error(f'Error in Crossref Marple query: {affiliation} - {e}')
-    return results
+def get_default_backend(name):
+    with backend_lock:
+        if name not in default_backends:
+            default_backends[name] = MarpleBackend() if name == 'marple' else RorApiBackend()
+        return default_backends[name]
 
 
-def parse_affiliation(s, crf_model, country_dict, institution_dict, address_dict, verbose):
-    tokens = tokenize(s)
-    features = [extract_features(
-        tokens, i, country_dict, institution_dict, address_dict) for i in range(len(tokens))]
-    labels = crf_model.predict_single(features)
+def query_marple(affiliation, verbose, backend=None):
+    return (backend or get_default_backend('marple')).query(affiliation, verbose)
+
+
+def parse_affiliation(s, crf_model, country_dict, institution_dict, address_dict, verbose, gazetteer=None, parse_cache=None):
+    if parse_cache:
+        parsed = parse_cache.get(s)
+        if parsed is not None:
+            return parsed
+    with metrics.timer('tokenize'):
+        tokens = tokenize(s)
+    if isinstance(crf_model, CompiledCRF):
+        with metrics.timer('predict_tokens'):
+            labels = crf_model.predict_tokens(
+                [tokens], country_dict, institution_dict, address_dict, gazetteer)[0]
+    else:
+        with metrics.timer('featurize'):
+            features = tokens2features(tokens, country_dict, institution_dict, address_dict, gazetteer)
+        with crf_lock, metrics.timer('predict_single'):
+            labels = crf_model.predict_single(features)
     if verbose:
         logging.debug(f"Parsed affiliation: {list(zip(tokens, labels))}")
+    parsed = group_labeled_tokens(tokens, labels)
+    if parse_cache:
+        parse_cache.set(s, parsed)
+    return parsed
+
+
+def parse_affiliations_batch(strings, crf_model, country_dict, institution_dict, address_dict, verbose=False, gazetteer=None, parse_cache=None):
+    if parse_cache:
+        parsed = [parse_cache.get(s) for s in strings]
+        misses = [i for i, cached in enumerate(parsed) if cached is None]
+        if misses:
+            miss_parsed = parse_affiliations_batch([strings[i] for i in misses], crf_model, country_dict,
+                                                   institution_dict, address_dict, verbose, gazetteer)
+            for i, parsed_affiliation in zip(misses, miss_parsed):
+                parsed[i] = parsed_affiliation
+                parse_cache.set(strings[i], parsed_affiliation)
+        return parsed
+    tokenized = []
+    for s in strings:
+        with metrics.timer('tokenize'):
+            tokenized.append(tokenize(s))
+    indices = [i for i, tokens in enumerate(tokenized) if tokens]
+    if isinstance(crf_model, CompiledCRF):
+        with metrics.timer('predict_tokens'):
+            predicted = crf_model.predict_tokens([tokenized[i] for i in indices], country_dict,
+                                                 institution_dict, address_dict, gazetteer)
+    else:
+        X = []
+        for i in indices:
+            with metrics.timer('featurize'):
+                X.append(tokens2features(tokenized[i], country_dict, institution_dict, address_dict, gazetteer))
+        with crf_lock, metrics.timer('predict_batch'):
+            predicted = crf_model.predict(X) if X else []
+    parsed = [([], [], []) for _ in strings]
+    for i, labels in zip(indices, predicted):
+        if verbose:
+            logging.debug(f"Parsed affiliation: {list(zip(tokenized[i], labels))}")
+        parsed[i] = group_labeled_tokens(tokenized[i], labels)
+    return parsed
+
+
+def group_labeled_tokens(tokens, labels):
     result = []
     current_label = labels[0]
     current_tokens = [tokens[0]]
@@ -70,27 +121,8 @@ def parse_affiliation(s, crf_model, country_dict, institution_dict, address_dict
     return institutions, addresses, countries
 
 
-def query_affiliation(affiliation, verbose):
-    results = []
-    try:
-        url = "https://api.ror.org/organizations"
-        params = {"affiliation": affiliation}
-        r = requests.get(url, params=params)
-        api_response = r.json()
-        items = api_response.get('items', [])
-        for item in items:
-            if item.get('chosen'):
-                org_id = item['organization']['id']
-                score = item['score']
-                results.append((org_id, score))
-                if verbose:
-                    logging.debug(f"Match found for '{affiliation}': {org_id} (score: {score})")
-                break
-        if not results and verbose:
-            logging.debug(f"No match found for '{affiliation}' in initial query")
-    except Exception as e:
-        logging.error(f'Error for query: {affiliation} - {e}')
-    return results
+def query_affiliation(affiliation, verbose, backend=None):
+    return (backend or get_default_backend('ror')).query(affiliation, verbose)
 
 
 def normalize_punctuation(text):
@@ -104,22 +136,68 @@ def normalize_punctuation(text):
     ).strip()
 
 
-def execute_fallback_query(affiliation, crf_model, country_dict, institution_dict, address_dict, verbose):
+def result_score(results):
+    try:
+        return float(results[0][1])
+    except (TypeError, ValueError):
+        return float('-inf')
+
+
+def fan_out_queries(queries, verbose, ror_backend, fanout, executor):
+    # All queries are sent at once. 'first' keeps the earliest query in
+    # order that matched, as the sequential loop would, 'best' the highest
+    # scoring match with ties going to the earlier query
+    futures = {}
+    for query in queries:
+        if query not in futures:
+            futures[query] = executor.submit(query_affiliation, query, verbose, ror_backend)
+    metrics.increment('fallback_fanout_queries', len(futures))
+    if fanout == 'first':
+        for i, query in enumerate(queries):
+            results = futures[query].result()
+            if results:
+                for future in futures.values():
+                    future.cancel()
+                return results, queries[:i + 1]
+        return [], queries
+    best = []
+    for query in queries:
+        results = futures[query].result()
+        if results and (not best or result_score(results) > result_score(best)):
+            best = results
+    return best, queries
+
+
+def build_fallback_queries(parsed):
+    institutions, _, countries = parsed
+    normalized_country = normalize_punctuation(countries[0] if countries else "")
+    return [f"{normalize_punctuation(institution)}, {normalized_country}".strip(", ")
+            for institution in institutions]
+
+
+def execute_fallback_query(affiliation, crf_model, country_dict, institution_dict, address_dict, verbose, ror_backend=None, parsed=None, gazetteer=None, parse_cache=None, cancelled=None, fanout=None, fanout_executor=None):
     results = []
     fallback_queries = []
     try:
-        institutions, _, countries = parse_affiliation(
-            affiliation, crf_model, country_dict, institution_dict, address_dict, verbose)
-        country = countries[0] if countries else ""
-        for institution in institutions:
-            normalized_institution = normalize_punctuation(institution)
-            normalized_country = normalize_punctuation(country)
-            query = f"{normalized_institution}, {normalized_country}".strip(", ")
-            fallback_queries.append(query)
-            query_results = query_affiliation(query, verbose)
-            results.extend(query_results)
-            if results:
-                break
+        if parsed is None:
+            parsed = parse_affiliation(
+                affiliation, crf_model, country_dict, institution_dict, address_dict, verbose, gazetteer,
+                parse_cache)
+        queries = build_fallback_queries(parsed)
+        with metrics.timer('fallback_affiliation'):
+            if fanout and fanout_executor and len(queries) > 1:
+                if cancelled is None or not cancelled.is_set():
+                    results, fallback_queries = fan_out_queries(
+                        queries, verbose, ror_backend, fanout, fanout_executor)
+            else:
+                for query in queries:
+                    if cancelled is not None and cancelled.is_set():
+                        break
+                    fallback_queries.append(query)
+                    query_results = query_affiliation(query, verbose, ror_backend)
+                    results.extend(query_results)
+                    if results:
+                        break
         if verbose:
             logging.debug(f"Fallback queries executed for: {affiliation}")
             logging.debug(f"Fallback query texts: {'; '.join(fallback_queries)}")
@@ -132,56 +210,366 @@ def execute_fallback_query(affiliation, crf_model, country_dict, institution_dic
     return results, '; '.join(fallback_queries)
 
 
-def parse_and_query(input_file, output_file, crf_model, country_dict, institution_dict, address_dict, verbose):
+def parse_for_fallback(affiliations, crf_model, country_dict, institution_dict, address_dict, verbose, gazetteer=None, parse_cache=None):
+    try:
+        return parse_affiliations_batch(
+            affiliations, crf_model, country_dict, institution_dict, address_dict, verbose,
+            gazetteer, parse_cache)
+    except Exception as e:
+        logging.error(f'Error in batch parse, parsing affiliations individually: {e}')
+        return [None] * len(affiliations)
+
+
+def fallback_cost(parsed, ror_backend):
+    # Most network calls the fallback queries for a parse can make; a
+    # Marple query always costs one
+    if not getattr(ror_backend or get_default_backend('ror'), 'remote', True):
+        return 0
+    if parsed is None:
+        return float('inf')
+    return len(parsed[0])
+
+
+def parse_shape(parsed):
+    institutions, _, countries = parsed
+    return min(len(institutions), 3), bool(countries)
+
+
+def cached_results(backend, query):
+    cache = getattr(backend, 'cache', None)
+    return cache.peek(backend.cache_endpoint, query) if cache else None
+
+
+class CascadeStats:
+    # Success rates of Marple and of the fallback queries, and the mean
+    # number of fallback API calls, per parse shape. They are learned from the
+    # rows resolved so far with that side tried first, and start from a prior
+    # of an even chance and the fallback_cost of the row.
+    def __init__(self, prior_weight=2.0, prior_rate=0.5):
+        self.lock = threading.Lock()
+        self.prior_weight = prior_weight
+        self.prior_rate = prior_rate
+        self.counts = {}
+
+    def record(self, shape, source, success, calls):
+        with self.lock:
+            tries, hits, total_calls = self.counts.get((shape, source), (0, 0, 0))
+            self.counts[(shape, source)] = (tries + 1, hits + bool(success), total_calls + calls)
+
+    def estimate(self, shape, source, prior_calls):
+        with self.lock:
+            tries, hits, total_calls = self.counts.get((shape, source), (0, 0, 0))
+        weight = tries + self.prior_weight
+        return ((hits + self.prior_weight * self.prior_rate) / weight,
+                (total_calls + self.prior_weight * prior_calls) / weight)
+
+    def fallback_first(self, affiliation, parsed, marple_backend, ror_backend):
+        if parsed is None or not parsed[0]:
+            return False
+        # A cached answer costs no call; a cached Marple answer is used as
+        # marple-first would, and a cached fallback match is taken first
+        if cached_results(marple_backend or get_default_backend('marple'), affiliation) is not None:
+            return False
+        if cached_results(ror_backend or get_default_backend('ror'), build_fallback_queries(parsed)[0]):
+            return True
+        # Expected network calls of each order: the first side's calls, plus
+        # the other side's when the first one finds nothing
+        shape = parse_shape(parsed)
+        marple_rate, _ = self.estimate(shape, 'marple', 1)
+        fallback_rate, fallback_calls = self.estimate(
+            shape, 'fallback', fallback_cost(parsed, ror_backend))
+        return fallback_calls + (1 - fallback_rate) < 1 + (1 - marple_rate) * fallback_calls
+
+    def snapshot(self):
+        with self.lock:
+            return {f"{shape[0]}_institutions{'_country' if shape[1] else ''}_{source}":
+                    {'tries': tries, 'hits': hits, 'calls': calls}
+                    for (shape, source), (tries, hits, calls) in sorted(self.counts.items())}
+
+
+def resolve_affiliations(affiliations, crf_model, country_dict, institution_dict, address_dict, verbose, executor=None, marple_backend=None, ror_backend=None, gazetteer=None, parse_cache=None, strategy='marple-first', fanout=None, fanout_executor=None, cascade_stats=None):
+    map_fn = executor.map if executor else map
+    marple = partial(query_marple, verbose=verbose, backend=marple_backend)
+
+    def fallback(affiliation, parsed_affiliation, cancelled=None):
+        return execute_fallback_query(affiliation, crf_model, country_dict, institution_dict,
+                                      address_dict, verbose, ror_backend=ror_backend,
+                                      parsed=parsed_affiliation, gazetteer=gazetteer,
+                                      parse_cache=parse_cache, cancelled=cancelled, fanout=fanout,
+                                      fanout_executor=fanout_executor)
+
+    if strategy == 'parallel' and executor is None:
+        raise ValueError("The parallel strategy needs more than one worker")
+    if strategy == 'marple-first':
+        marple_results = list(map_fn(marple, affiliations))
+        outcomes = [(results, "marple" if results else "no_match", "")
+                    for results in marple_results]
+        misses = [i for i, results in enumerate(marple_results) if not results]
+        miss_affiliations = [affiliations[i] for i in misses]
+        parsed = parse_for_fallback(miss_affiliations, crf_model, country_dict, institution_dict,
+                                    address_dict, verbose, gazetteer, parse_cache)
+        fallback_results = map_fn(fallback, miss_affiliations, parsed)
+        for i, (results, fallback_queries) in zip(misses, fallback_results):
+            match_type = "crf_fallback" if results else "no_match"
+            outcomes[i] = (results, match_type, fallback_queries)
+        return outcomes
+
+    parsed = parse_for_fallback(affiliations, crf_model, country_dict, institution_dict,
+                                address_dict, verbose, gazetteer, parse_cache)
+    if strategy == 'parallel':
+        # Marple and the fallback queries for a row run side by side. A Marple
+        # match wins, as with marple-first, and stops any fallback queries
+        # that have not been sent yet.
+        pending = []
+        for affiliation, parsed_affiliation in zip(affiliations, parsed):
+            cancelled = threading.Event()
+            marple_future = executor.submit(marple, affiliation)
+            marple_future.add_done_callback(
+                lambda future, cancelled=cancelled: cancelled.set() if future.result() else None)
+            fallback_future = executor.submit(fallback, affiliation, parsed_affiliation, cancelled)
+            pending.append((marple_future, fallback_future))
+        outcomes = []
+        for marple_future, fallback_future in pending:
+            results = marple_future.result()
+            if results:
+                outcomes.append((results, "marple", ""))
+                continue
+            results, fallback_queries = fallback_future.result()
+            outcomes.append((results, "crf_fallback" if results else "no_match", fallback_queries))
+        return outcomes
+
+    stats = (cascade_stats or CascadeStats()) if strategy == 'cheapest' else None
+
+    def cascade(affiliation, parsed_affiliation):
+        use_marple = strategy != 'crf-only'
+        fallback_first = not use_marple or strategy == 'crf-first' or (
+            stats is not None and stats.fallback_first(affiliation, parsed_affiliation,
+                                                       marple_backend, ror_backend))
+        shape = parse_shape(parsed_affiliation) if stats and parsed_affiliation else None
+        if not fallback_first:
+            results = marple(affiliation)
+            if shape:
+                stats.record(shape, 'marple', results, 1)
+            if results:
+                return results, "marple", ""
+        results, fallback_queries = fallback(affiliation, parsed_affiliation)
+        if shape and fallback_first:
+            calls = fallback_queries.count('; ') + 1 if fallback_queries else 0
+            stats.record(shape, 'fallback', results,
+                         calls if fallback_cost(parsed_affiliation, ror_backend) else 0)
+        if results:
+            return results, "crf_fallback", fallback_queries
+        if fallback_first and use_marple:
+            results = marple(affiliation)
+            if results:
+                return results, "marple", fallback_queries
+        return [], "no_match", fallback_queries
+
+    return list(map_fn(cascade, affiliations, parsed))
+
+
+def network_calls():
+    timers = metrics.snapshot()['timers']
+    return {name: timers.get(f'http_{name}', {}).get('count', 0) for name in ('marple', 'ror')}
+
+
+def resolve_deduplicated(affiliations, resolved, crf_model, country_dict, institution_dict, address_dict, verbose, **kwargs):
+    # resolved is an LRU cache, so the outcomes of this batch are kept aside
+    # in case resolving it evicts some of them
+    keys = [normalize_punctuation(affiliation) for affiliation in affiliations]
+    outcomes = {}
+    pending = {}
+    for key, affiliation in zip(keys, affiliations):
+        if key in outcomes or key in pending:
+            continue
+        outcome = resolved.get(key)
+        if outcome is None:
+            pending[key] = affiliation
+        else:
+            outcomes[key] = outcome
+    if pending:
+        for key, outcome in zip(pending, resolve_affiliations(
+                list(pending.values()), crf_model, country_dict, institution_dict,
+                address_dict, verbose, **kwargs)):
+            outcomes[key] = outcome
+            resolved.set(key, outcome)
+    return [outcomes[key] for key in keys]
+
+
+def format_outcome(results, match_type, fallback_queries):
+    if results:
+        predicted_ids = ";".join([r[0] for r in results])
+        prediction_scores = ";".join([str(r[1]) for r in results])
+    else:
+        predicted_ids = None
+        prediction_scores = None
+    return {
+        "predicted_ror_id": predicted_ids,
+        "prediction_score": prediction_scores,
+        "match_type": match_type,
+        "fallback_queries": fallback_queries
+    }
+
+
+def iter_batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def initial_state(input_file, output_file, shard, resume):
+    state = {'input_file': os.path.abspath(input_file), 'shard': list(shard) if shard else None,
+             'rows_consumed': 0, 'rows_written': 0, 'output_offset': 0}
+    if not resume:
+        return state
+    saved = load_checkpoint(output_file)
+    if saved is None:
+        logging.info(f"No checkpoint found for {output_file}, starting from the beginning")
+        return state
+    if saved['input_file'] != state['input_file'] or saved['shard'] != state['shard']:
+        raise ValueError(f"Checkpoint for {output_file} was written for input {saved['input_file']} "
+                         f"and shard {saved['shard']}")
+    logging.info(f"Resuming after {saved['rows_consumed']} input rows "
+                 f"({saved['rows_written']} output rows)")
+    return saved
+
+
+def parse_and_query(input_file, output_file, crf_model, country_dict, institution_dict, address_dict, verbose, workers=1, batch_size=100, marple_backend=None, ror_backend=None, dedupe=False, gazetteer=None, checkpoint_every=0, resume=False, shard=None, progress_interval=0, parse_cache=None, input_format=None, output_format=None, strategy='marple-first', fanout=None, fanout_workers=8, dedupe_size=100000):
+    resolved = LRUCache(dedupe_size, 'dedupe') if dedupe else None
+    cascade_stats = CascadeStats() if strategy == 'cheapest' else None
+    total_rows = 0
+    start = last_progress = time.perf_counter()
+    calls_before = network_calls()
+    input_format = detect_format(input_file, input_format)
+    output_format = detect_format(output_file, output_format)
+    if not is_plain_file(output_file):
+        if resume:
+            raise ValueError(f"Resuming needs a plain output file, not {output_file}")
+        checkpoint_every = 0
+    state = initial_state(input_file, output_file, shard, resume)
     try:
-        with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w') as f_out:
-            reader = csv.DictReader(f_in)
-            fieldnames = reader.fieldnames + [
+        with open_text(input_file, 'r') as f_in, \
+                open_text(output_file, 'r+' if state['output_offset'] else 'w') as f_out, \
+                ThreadPoolExecutor(max_workers=workers) as executor, \
+                ThreadPoolExecutor(max_workers=fanout_workers) as fanout_executor:
+            input_fieldnames, records = record_reader(f_in, input_format)
+            fieldnames = input_fieldnames + [
                 "predicted_ror_id", "prediction_score",
                 "match_type", "fallback_queries"
             ]
-            writer = csv.DictWriter(f_out, fieldnames=fieldnames)
-            writer.writeheader()
-            for row in reader:
-                affiliation = row['affiliation']
-                results = []
-                match_type = "no_match"
-                fallback_queries = ""
-                results = query_marple(affiliation, verbose)
-                if results:
-                    match_type = "marple"
-                if not results:
-                    results, fallback_queries = execute_fallback_query(
-                        affiliation, crf_model, country_dict, institution_dict, address_dict, verbose)
-                    if results:
-                        match_type = "crf_fallback"
-                if results:
-                    predicted_ids = ";".join([r[0] for r in results])
-                    prediction_scores = ";".join([str(r[1]) for r in results])
+            writer = RecordWriter(f_out, output_format, fieldnames)
+            if state['output_offset']:
+                # Drop anything written after the last checkpoint
+                f_out.seek(state['output_offset'])
+                f_out.truncate()
+            else:
+                writer.write_header()
+            rows = islice(enumerate(records), state['rows_consumed'], None)
+            if shard:
+                shard_index, shard_count = shard
+                rows = ((i, row) for i, row in rows if i % shard_count == shard_index)
+            last_checkpoint = state['rows_written']
+            for batch in iter_batches(rows, batch_size):
+                affiliations = [row['affiliation'] for _, row in batch]
+                total_rows += len(batch)
+                resolve_kwargs = {'executor': executor if workers > 1 else None,
+                                  'marple_backend': marple_backend, 'ror_backend': ror_backend,
+                                  'gazetteer': gazetteer, 'parse_cache': parse_cache,
+                                  'strategy': strategy, 'fanout': fanout,
+                                  'fanout_executor': fanout_executor if fanout else None,
+                                  'cascade_stats': cascade_stats}
+                if dedupe:
+                    outcomes = resolve_deduplicated(
+                        affiliations, resolved, crf_model, country_dict, institution_dict,
+                        address_dict, verbose, **resolve_kwargs)
                 else:
-                    predicted_ids = None
-                    prediction_scores = None
-
-                row.update({
-                    "predicted_ror_id": predicted_ids,
-                    "prediction_score": prediction_scores,
-                    "match_type": match_type,
-                    "fallback_queries": fallback_queries
-                })
-                writer.writerow(row)
-                if verbose:
-                    logging.debug(f"Processed affiliation: {affiliation}, Match type: {match_type}, Fallback queries: {fallback_queries}")
+                    outcomes = resolve_affiliations(
+                        affiliations, crf_model, country_dict, institution_dict, address_dict,
+                        verbose, **resolve_kwargs)
+                with metrics.timer('output_write'):
+                    for (_, row), outcome in zip(batch, outcomes):
+                        row.update(format_outcome(*outcome))
+                        writer.write(row)
+                        metrics.increment(f"match_{row['match_type']}")
+                        if verbose:
+                            logging.debug(f"Processed affiliation: {row['affiliation']}, Match type: {row['match_type']}, Fallback queries: {row['fallback_queries']}")
+                metrics.increment('rows', len(batch))
+                now = time.perf_counter()
+                if progress_interval and now - last_progress >= progress_interval:
+                    logging.info(f"Progress: {total_rows} rows, {total_rows / (now - start):.1f} rows/sec; {metrics.summary()}")
+                    last_progress = now
+                state['rows_consumed'] = batch[-1][0] + 1
+                state['rows_written'] += len(batch)
+                if checkpoint_every and state['rows_written'] - last_checkpoint >= checkpoint_every:
+                    writer.flush()
+                    os.fsync(f_out.fileno())
+                    state['output_offset'] = f_out.tell()
+                    save_checkpoint(output_file, state)
+                    last_checkpoint = state['rows_written']
+            writer.flush()
+            if checkpoint_every or resume:
+                # The output must be on disk before the checkpoint that could
+                # recover it is removed
+                os.fsync(f_out.fileno())
+        if checkpoint_every or resume:
+            remove_checkpoint(output_file)
+    except BrokenPipeError:
+        raise
     except Exception as e:
-        logging.error(f'Error in parse_and_query: {e}')
+        logging.error(f'Error in parse_and_query after {state["rows_consumed"]} input rows: {e}')
+        raise
+    finally:
+        if total_rows:
+            calls = {name: count - calls_before[name] for name, count in network_calls().items()}
+            logging.info(f"Network calls with the {strategy} strategy: Marple {calls['marple']}, "
+                         f"ROR {calls['ror']}, {1000 * sum(calls.values()) / total_rows:.1f} per 1k rows")
+        if cascade_stats:
+            logging.info(f"Cheapest strategy tries and hits by parse shape: {cascade_stats.snapshot()}")
+        if dedupe and total_rows:
+            # Each miss was resolved once; an affiliation evicted from the
+            # cache and seen again counts twice
+            unique = resolved.stats()['misses']
+            duplication_ratio = 1 - unique / total_rows
+            logging.info(f"Deduplicated {total_rows} rows to {unique} resolved affiliations "
+                         f"(duplication ratio: {duplication_ratio:.4f})")
+
+
+def shard_spec(spec):
+    index, sep, count = spec.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index, count = -1, 0
+    if not sep or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            f"Invalid shard '{spec}', expected INDEX/COUNT with 0 <= INDEX < COUNT")
+    return index, count
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} must be at least 1")
+    return number
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Return ROR affiliation matches for a given CSV file.')
-    parser.add_argument('-i', '--input', help='Input CSV file', required=True)
-    parser.add_argument('-o', '--output', help='Output CSV file',
-                        default='ror-affiliation_results.csv')
-    parser.add_argument('-m', '--model', help='Path to the trained CRF model file',
+    parser.add_argument('-i', '--input', required=True,
+                        help='Input CSV or JSONL file, optionally .gz or .zst compressed, or - for stdin')
+    parser.add_argument('-o', '--output', default='ror-affiliation_results.csv',
+                        help='Output CSV or JSONL file, optionally .gz or .zst compressed, or - for stdout')
+    parser.add_argument('--input-format', choices=FORMATS,
+                        help='Input format (default: from the file extension, CSV unless .jsonl or .ndjson)')
+    parser.add_argument('--output-format', choices=FORMATS,
+                        help='Output format (default: from the file extension, CSV unless .jsonl or .ndjson)')
+    parser.add_argument('-m', '--model', help='Path to the trained CRF model file (.joblib, its memory-mapped .crfm copy, or .npz exported with --export_compiled)',
                         default='model/affiliation_parser_crf_model.joblib')
     parser.add_argument(
         '-c', '--countries', help='File containing list of countries', default='data/countries.txt')
@@ -189,23 +577,92 @@ def parse_arguments():
                         default='data/institution_keywords.txt')
     parser.add_argument('-d', '--addresses', help='File containing address keywords',
                         default='data/address_keywords.txt')
+    parser.add_argument('--gazetteer', action='store_true',
+                        help='Add multi-word dictionary match features (the model must be trained with --gazetteer)')
     parser.add_argument('--use-crossref-marple', action='store_true',
-                        help='Enable Crossref Marple API query')
+                        help='Deprecated: Marple is queried by every strategy except crf-only')
+    parser.add_argument('--strategy', choices=STRATEGIES, default='marple-first',
+                        help='Order of the Marple and CRF fallback queries, or crf-only to skip Marple')
+    parser.add_argument('-w', '--workers', type=positive_int, default=1,
+                        help='Number of concurrent API queries (1 runs sequentially)')
+    parser.add_argument('--fallback-fanout', choices=FANOUT_RULES,
+                        help='Send all fallback queries of an affiliation at once and keep the first match in order or the best scoring one')
+    parser.add_argument('--fanout-workers', type=positive_int, default=8,
+                        help='Number of concurrent fallback queries with --fallback-fanout')
+    parser.add_argument('-b', '--batch-size', type=int, default=100,
+                        help='Number of rows resolved per batch')
+    parser.add_argument('--checkpoint-every', type=int, default=1000,
+                        help='Save a checkpoint after this many output rows (0 disables checkpoints)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue from the checkpoint of a previous run with the same output file')
+    parser.add_argument('--shard', type=shard_spec, metavar='INDEX/COUNT',
+                        help='Process only input rows whose position modulo COUNT equals INDEX')
+    parser.add_argument('--progress-interval', type=float, default=60,
+                        help='Seconds between progress lines in the log (0 disables them)')
+    parser.add_argument('--metrics-output',
+                        help='File to write stage timings and counters to at the end of the run (JSON if it ends in .json, otherwise Prometheus text)')
+    parser.add_argument('--profile',
+                        help='Run under cProfile and write the stats to this file')
+    parser.add_argument('--parse-cache-size', type=int, default=10000,
+                        help='Number of CRF parses kept in an in-memory LRU cache (0 disables it)')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Resolve each distinct affiliation once and copy the result to its duplicates')
+    parser.add_argument('--dedupe-size', type=positive_int, default=100000,
+                        help='Number of resolved affiliations kept for --dedupe, least recently seen are dropped first')
+    add_backend_arguments(parser)
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Enable verbose logging')
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.use_crossref_marple and args.strategy == 'crf-only':
+        parser.error("--use-crossref-marple cannot be combined with --strategy crf-only")
+    if args.strategy == 'parallel' and args.workers < 2:
+        parser.error("--strategy parallel needs -w/--workers of at least 2")
+    return args
 
 
 def main():
     args = parse_arguments()
     setup_logging(args.verbose)
+    if args.use_crossref_marple:
+        logging.warning("--use-crossref-marple is deprecated and will be removed: Marple is queried by "
+                        "default, use --strategy crf-only to skip it")
     logging.info("Loading CRF model and dictionaries...")
-    crf_model = joblib.load(args.model)
+    crf_model = load_crf_model(args.model)
     country_dict, institution_dict, address_dict = create_dictionaries(
         args.countries, args.institutions, args.addresses)
+    gazetteer = build_gazetteer(
+        country_dict, institution_dict, address_dict) if args.gazetteer else None
+    pool_size = args.workers + (args.fanout_workers if args.fallback_fanout else 0)
+    marple_backend, ror_backend = create_backends(args, pool_size=pool_size)
+    parse_cache = ParseCache(args.parse_cache_size) if args.parse_cache_size > 0 else None
     logging.info("Starting affiliation parsing and querying...")
-    parse_and_query(args.input, args.output, crf_model,
-                    country_dict, institution_dict, address_dict, args.verbose)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        parse_and_query(args.input, args.output, crf_model,
+                        country_dict, institution_dict, address_dict, args.verbose,
+                        workers=args.workers, batch_size=args.batch_size, marple_backend=marple_backend,
+                        ror_backend=ror_backend, dedupe=args.dedupe, dedupe_size=args.dedupe_size, gazetteer=gazetteer,
+                        checkpoint_every=args.checkpoint_every, resume=args.resume, shard=args.shard,
+                        progress_interval=args.progress_interval, parse_cache=parse_cache,
+                        input_format=args.input_format, output_format=args.output_format,
+                        strategy=args.strategy,
+                        fanout=args.fallback_fanout, fanout_workers=args.fanout_workers)
+    except BrokenPipeError:
+        logging.info("Output pipe closed by its reader, stopping")
+        exit_on_broken_pipe()
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logging.info(f"Profile written to {args.profile}")
+        close_backends(marple_backend, ror_backend)
+        if parse_cache:
+            logging.info(f"Parse cache stats: {parse_cache.stats()}")
+        logging.info(f"Stage metrics: {metrics.summary()}")
+        if args.metrics_output:
+            metrics.dump(args.metrics_output)
     logging.info("Affiliation parsing and querying completed.")
 
 
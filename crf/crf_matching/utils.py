@@ -1,15 +1,19 @@
+import os
 import re
+import glob
+import gzip
 import xml.etree.ElementTree as ET
 
 
+TOKEN_PATTERN = re.compile(r"""
+    ( [^\W\d_]+     # letters
+    | \d+           # digits
+    | [^\w\s]       # single other character (not letter, digit, or whitespace)
+    )""", re.UNICODE | re.VERBOSE)
+
+
 def tokenize(s):
-    token_pattern = re.compile(r"""
-        ( [^\W\d_]+     # letters
-        | \d+           # digits
-        | [^\w\s]       # single other character (not letter, digit, or whitespace)
-        )""", re.UNICODE | re.VERBOSE)
-    tokens = token_pattern.findall(s)
-    return tokens
+    return TOKEN_PATTERN.findall(s)
 
 
 def extract_features(tokens, i, country_dict, institution_dict, address_dict):
@@ -90,6 +94,65 @@ def extract_features(tokens, i, country_dict, institution_dict, address_dict):
     return features
 
 
+CONTEXT_ATTRIBUTES = ('word.lower()', 'word.isdigit()', 'word.isupper()', 'word.islower()',
+                      'word.istitle()', 'word.iscountry()', 'word.isinstitution()', 'word.isaddress()')
+PREV2_KEYS = tuple(f'-2:{name}' for name in CONTEXT_ATTRIBUTES)
+PREV1_KEYS = tuple(f'-1:{name}' for name in CONTEXT_ATTRIBUTES)
+NEXT1_KEYS = tuple(f'+1:{name}' for name in CONTEXT_ATTRIBUTES)
+NEXT2_KEYS = tuple(f'+2:{name}' for name in CONTEXT_ATTRIBUTES)
+
+
+def token_attributes(token, country_dict, institution_dict, address_dict):
+    # Ordered as CONTEXT_ATTRIBUTES, with startupper last so that zipping
+    # against the context keys leaves it out
+    lower = token.lower()
+    return (lower, token.isdigit(), token.isupper(), token.islower(), token.istitle(),
+            lower in country_dict, lower in institution_dict, lower in address_dict,
+            token[0].isupper() and token[1:].islower() if len(token) > 1 else False)
+
+
+def tokens2features(tokens, country_dict, institution_dict, address_dict, gazetteer=None):
+    attributes = [token_attributes(token, country_dict, institution_dict, address_dict)
+                  for token in tokens]
+    gazetteer_spans = gazetteer_tags(tokens, gazetteer) if gazetteer else None
+    last = len(tokens) - 1
+    sent_features = []
+    for i, (lower, isdigit, isupper, islower, istitle,
+            iscountry, isinstitution, isaddress, startupper) in enumerate(attributes):
+        features = {
+            'bias': 1.0,
+            'word.lower()': lower,
+            'word.isdigit()': isdigit,
+            'word.isupper()': isupper,
+            'word.islower()': islower,
+            'word.istitle()': istitle,
+            'word.isnumber()': isdigit,
+            'word.allupper()': isupper,
+            'word.alllower()': islower,
+            'word.startupper()': startupper,
+            'word.iscountry()': iscountry,
+            'word.isinstitution()': isinstitution,
+            'word.isaddress()': isaddress,
+        }
+        if i > 0:
+            features.update(zip(PREV1_KEYS, attributes[i - 1]))
+        else:
+            features['BOS'] = True
+        if i > 1:
+            features.update(zip(PREV2_KEYS, attributes[i - 2]))
+        if i < last:
+            features.update(zip(NEXT1_KEYS, attributes[i + 1]))
+        else:
+            features['EOS'] = True
+        if i < last - 1:
+            features.update(zip(NEXT2_KEYS, attributes[i + 2]))
+        if gazetteer_spans:
+            for category, tag in gazetteer_spans[i].items():
+                features[f'word.{category}_gazetteer()'] = tag
+        sent_features.append(features)
+    return sent_features
+
+
 def create_dictionaries(country_file, institution_file, address_file):
     def read_file_to_set(filename):
         with open(filename, 'r', encoding='utf-8') as file:
@@ -100,35 +163,116 @@ def create_dictionaries(country_file, institution_file, address_file):
     return country_dict, institution_dict, address_dict
 
 
+def build_gazetteer(country_dict, institution_dict, address_dict):
+    # Token trie over the multi-word dictionary entries; single-word entries
+    # are already covered by the word.is*() features
+    gazetteer = {}
+    for category, entries in (('country', country_dict),
+                              ('institution', institution_dict),
+                              ('address', address_dict)):
+        for entry in entries:
+            tokens = tokenize(entry)
+            if len(tokens) < 2:
+                continue
+            node = gazetteer
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node.setdefault(None, set()).add(category)
+    return gazetteer
+
+
+def gazetteer_tags(tokens, gazetteer):
+    lowered = [token.lower() for token in tokens]
+    tags = [{} for _ in tokens]
+    covered_until = {}
+    for i in range(len(lowered)):
+        node = gazetteer
+        longest = {}
+        for j in range(i, len(lowered)):
+            node = node.get(lowered[j])
+            if node is None:
+                break
+            for category in node.get(None, ()):
+                longest[category] = j
+        for category, end in longest.items():
+            # Leftmost-longest: skip matches starting inside an earlier one
+            if i < covered_until.get(category, 0):
+                continue
+            tags[i][category] = 'B'
+            for k in range(i + 1, end + 1):
+                tags[k][category] = 'I'
+            covered_until[category] = end + 1
+    return tags
+
+
+def aff_to_training_data(aff):
+    aff_data = []
+    for element in aff:
+        tag = element.tag
+        text = element.text.strip() if element.text else ""
+        if text:
+            tokens = tokenize(text)
+            if tag == 'institution':
+                aff_data.extend((token, 'INSTITUTION') for token in tokens)
+            elif tag == 'addr-line':
+                aff_data.extend((token, 'ADDRESS') for token in tokens)
+            elif tag == 'country':
+                aff_data.extend((token, 'COUNTRY') for token in tokens)
+            # Add a separator token if it's not the last element and there's text
+            if element != aff[-1] and aff_data:
+                aff_data.append((',', 'O'))
+    return aff_data
+
+
+def expand_corpus_paths(paths):
+    if isinstance(paths, str):
+        paths = [paths]
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path):
+            expanded.extend(sorted(glob.glob(os.path.join(path, '*.xml')) +
+                                   glob.glob(os.path.join(path, '*.xml.gz'))))
+        elif glob.has_magic(path):
+            expanded.extend(sorted(glob.glob(path)))
+        else:
+            expanded.append(path)
+    return expanded
+
+
+def open_corpus_file(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_training_data_from_xml(paths):
+    # Streams <aff> elements that are direct children of the root, clearing
+    # each one once it is converted so memory stays flat
+    for path in expand_corpus_paths(paths):
+        with open_corpus_file(path) as f:
+            depth = 0
+            root = None
+            for event, element in ET.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1 and element.tag == 'aff':
+                    aff_data = aff_to_training_data(element)
+                    if aff_data:
+                        yield aff_data
+                    root.clear()
+
+
 def create_training_data_from_xml(xml_file):
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-    training_data = []
-    for aff in root.findall('aff'):
-        aff_data = []
-        for element in aff:
-            tag = element.tag
-            text = element.text.strip() if element.text else ""
-            if text:
-                tokens = tokenize(text)
-                if tag == 'institution':
-                    aff_data.extend((token, 'INSTITUTION') for token in tokens)
-                elif tag == 'addr-line':
-                    aff_data.extend((token, 'ADDRESS') for token in tokens)
-                elif tag == 'country':
-                    aff_data.extend((token, 'COUNTRY') for token in tokens)
-                # Add a separator token if it's not the last element and there's text
-                if element != aff[-1] and aff_data:
-                    aff_data.append((',', 'O'))
-        if aff_data:
-            training_data.append(aff_data)
-
-    return training_data
-
-
-def sent2features(sent, country_dict, institution_dict, address_dict):
+    return list(iter_training_data_from_xml(xml_file))
+
+
+def sent2features(sent, country_dict, institution_dict, address_dict, gazetteer=None):
     tokens = [token for token, label in sent]
-    return [extract_features(tokens, i, country_dict, institution_dict, address_dict) for i in range(len(tokens))]
+    return tokens2features(tokens, country_dict, institution_dict, address_dict, gazetteer)
 
 
 def sent2labels(sent):